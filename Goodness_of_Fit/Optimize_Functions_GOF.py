@@ -1,9 +1,171 @@
 import sys
 import os
+import itertools
+import multiprocessing
+import collections
+import hashlib
+import uuid
+import inspect
+import gzip
+import cPickle
+import cStringIO
 import numpy
+from scipy.special import gammaln
 import dadi
 from datetime import datetime
 
+#spectra cached by make_cached_extrap_func, shared by every cached function made in this process
+#so that repeated evaluations are found no matter which step of the routine asks for them
+_spectrum_cache = collections.OrderedDict()
+_spectrum_cache_stats = {'hits':0, 'misses':0}
+
+#running total of the bytes held in each on-disk spectrum cache directory, filled the first time a directory is used
+_disk_cache_bytes = {}
+#hash of the source code of each model function, so a spectrum cached on disk is not used after the model is edited
+_model_source_hashes = {}
+
+def model_source_hash(func):
+    #--------------------------------------------------------------------------------------
+    # return a hash of the source code of a model function (or of its compiled code if the source is not available)
+    
+    # Arguments
+    # func: access the model function, ex. Models_2D.no_mig
+    #--------------------------------------------------------------------------------------
+    if func not in _model_source_hashes:
+        try:
+            source = inspect.getsource(func)
+        except (IOError, TypeError):
+            source = func.func_code.co_code
+        _model_source_hashes[func] = hashlib.sha1(source).hexdigest()
+    return _model_source_hashes[func]
+
+def read_cached_spectrum(cache_dir, key):
+    #--------------------------------------------------------------------------------------
+    # return the spectrum stored on disk for this key, or None if there isn't one
+    
+    # Arguments
+    # cache_dir: directory holding the cached spectra
+    # key: the content hash naming the cached spectrum
+    #--------------------------------------------------------------------------------------
+    cachename = os.path.join(cache_dir, "{}.npz".format(key))
+    try:
+        stored = numpy.load(cachename)
+        sim_model = dadi.Spectrum(stored['data'], mask=stored['mask'], data_folded=bool(stored['folded']))
+        stored.close()
+        #mark the file as recently used so it is among the last to be evicted
+        os.utime(cachename, None)
+    except (IOError, OSError, KeyError, ValueError):
+        #missing, or removed by another run evicting files at the same time
+        return None
+    return sim_model
+
+def write_cached_spectrum(cache_dir, key, sim_model, cache_dir_mb):
+    #--------------------------------------------------------------------------------------
+    # store a spectrum on disk, then remove the least recently used spectra if the directory
+    # has grown past its size limit
+    
+    # Arguments
+    # cache_dir: directory holding the cached spectra
+    # key: the content hash naming the cached spectrum
+    # sim_model: the model spectrum
+    # cache_dir_mb: size limit for the directory in megabytes
+    #--------------------------------------------------------------------------------------
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            #made by another run in the meantime
+            pass
+    if cache_dir not in _disk_cache_bytes:
+        _disk_cache_bytes[cache_dir] = sum(os.path.getsize(os.path.join(cache_dir, x)) for x in os.listdir(cache_dir) if x.endswith(".npz"))
+
+    #write to a temporary file first so other runs never read a half written spectrum
+    cachename = os.path.join(cache_dir, "{}.npz".format(key))
+    tempname = "{0}.{1}.tmp".format(cachename, os.getpid())
+    fh_cache = open(tempname, 'wb')
+    numpy.savez(fh_cache, data=numpy.asarray(sim_model.data), mask=numpy.ma.getmaskarray(sim_model), folded=sim_model.folded)
+    fh_cache.close()
+    os.rename(tempname, cachename)
+    _disk_cache_bytes[cache_dir] += os.path.getsize(cachename)
+
+    #evict the least recently used spectra down to 90% of the limit
+    max_bytes = float(cache_dir_mb) * 1024 * 1024
+    if _disk_cache_bytes[cache_dir] > max_bytes:
+        cached = []
+        for x in os.listdir(cache_dir):
+            if x.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(cache_dir, x))
+                    cached.append([stat.st_mtime, stat.st_size, x])
+                except OSError:
+                    continue
+        cached.sort()
+        total = sum(x[1] for x in cached)
+        for mtime, size, x in cached:
+            if total <= 0.9 * max_bytes:
+                break
+            try:
+                os.remove(os.path.join(cache_dir, x))
+                total -= size
+            except OSError:
+                continue
+        _disk_cache_bytes[cache_dir] = total
+
+def make_cached_extrap_func(func, cache_size=10, digits=10, cache_dir=None, cache_dir_mb=1000):
+    #--------------------------------------------------------------------------------------
+    # create the extrapolating function for a model with dadi.Numerics.make_extrap_log_func, wrapped in a
+    # bounded least-recently-used cache keyed on (model, rounded params, ns, pts), so a parameter set that
+    # was already simulated on the same grid (ex. the optimizer's final step) is not integrated again
+    
+    # Arguments
+    # func: access the model function, ex. Models_2D.no_mig
+    # cache_size: the largest number of model spectra to keep, 0 or None turns the cache off
+    # digits: number of decimal places the parameters are rounded to when looking up a spectrum
+    # cache_dir: a directory where spectra are also stored as .npz files named by a hash of
+    #            (model name, model source code, rounded params, ns, pts), so they can be reused by later runs
+    # cache_dir_mb: size limit for cache_dir in megabytes, the least recently used spectra are removed past this
+    #--------------------------------------------------------------------------------------
+    func_exec = dadi.Numerics.make_extrap_log_func(func)
+    if not cache_size and cache_dir is None:
+        return func_exec
+
+    model_key = "{0}.{1}".format(func.__module__, func.__name__)
+    if cache_dir is not None:
+        model_key = "{0}.{1}".format(model_key, model_source_hash(func))
+    def cached_func_exec(params, ns, pts):
+        key = (model_key, tuple(numpy.around(params, digits)), tuple(int(n) for n in ns), tuple(pts))
+        if key in _spectrum_cache:
+            _spectrum_cache_stats['hits'] += 1
+            #move the spectrum to the most recently used end
+            sim_model = _spectrum_cache.pop(key)
+        else:
+            sim_model = None
+            if cache_dir is not None:
+                disk_key = hashlib.sha1(repr(key)).hexdigest()
+                sim_model = read_cached_spectrum(cache_dir, disk_key)
+            if sim_model is not None:
+                _spectrum_cache_stats['hits'] += 1
+            else:
+                _spectrum_cache_stats['misses'] += 1
+                sim_model = func_exec(params, ns, pts)
+                if cache_dir is not None:
+                    write_cached_spectrum(cache_dir, disk_key, sim_model, cache_dir_mb)
+        if not cache_size:
+            return sim_model
+        _spectrum_cache[key] = sim_model
+        while len(_spectrum_cache) > int(cache_size):
+            _spectrum_cache.popitem(last=False)
+        #hand back a copy so the cached spectrum can never be changed by the caller
+        return sim_model.copy()
+    return cached_func_exec
+
+def cache_info():
+    #--------------------------------------------------------------------------------------
+    # return the number of hits (in memory or on disk), misses, and spectra currently held in memory
+    # by the caches used in make_cached_extrap_func
+    #--------------------------------------------------------------------------------------
+    return _spectrum_cache_stats['hits'], _spectrum_cache_stats['misses'], len(_spectrum_cache)
+
 def parse_params(param_number, in_params=None, in_upper=None, in_lower=None):
     #--------------------------------------------------------------------------------------
     # function to correctly deal with parameters and bounds, if none were provided, generate them automatically
@@ -143,32 +305,50 @@ def collect_results(fs, sim_model, params_opt, roundrep):
     #send list of results back
     return temp_results
 
-def write_log(outfile, model_name, rep_results, roundrep):
+def write_log(outfile, model_name, rep_results, roundrep, optlog="", seed=None):
     #--------------------------------------------------------------------------------------
-    #reproduce replicate log to bigger log file, because constantly re-written
+    #add the log of a replicate to the bigger log file, in a single write so runs sharing the file don't interleave
     
     # Arguments =
     # outfile: prefix for output naming
     # model_name: a label to slap on the output files; ex. "no_mig"
     # rep_results: the list returned by collect_results function: [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
     # roundrep: name of replicate (ex, "Round_1_Replicate_10")
+    # optlog: the steps of the optimizer for this replicate, as caught by optimize_in_memory
+    # seed: the seed used to perturb the starting parameters of this replicate, written to the log if given
     #--------------------------------------------------------------------------------------
-    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
-    fh_log.write("\n{}\n".format(roundrep))
-    templogname = "{}.log.txt".format(model_name)
-    try:
-        fh_templog = open(templogname, 'r')
-        for line in fh_templog:
-            fh_log.write(line)
-        fh_templog.close()
-    except IOError:
+    log_lines = ["\n{}\n".format(roundrep)]
+    if seed is not None:
+        log_lines.append("seed = {}\n".format(seed))
+    if not optlog:
         print "Nothing written to log file this replicate..."
-    fh_log.write("likelihood = {}\n".format(rep_results[1]))
-    fh_log.write("theta = {}\n".format(rep_results[4]))
-    fh_log.write("Optimized parameters = {}\n".format(rep_results[5]))
+    log_lines.append(optlog)
+    log_lines.append("likelihood = {}\n".format(rep_results[1]))
+    log_lines.append("theta = {}\n".format(rep_results[4]))
+    log_lines.append("Optimized parameters = {}\n".format(rep_results[5]))
+    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
+    fh_log.write("".join(log_lines))
     fh_log.close()
 
-def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_number, reps=None, maxiters=None, folds=None, in_params=None, in_upper=None, in_lower=None, param_labels=" "):
+def optimize_in_memory(trace, params_perturbed, fs, func_exec, pts, lower_bound, upper_bound, maxiter):
+    #--------------------------------------------------------------------------------------
+    # run dadi.Inference.optimize_log_fmin and return the optimized parameters, with the step by step
+    # output of the optimizer written to trace rather than to a log file on disk; given no output file
+    # the optimizer writes to sys.stdout, so that is swapped for trace while it runs
+    
+    # Arguments
+    # trace: a file-like object kept in memory, ex. cStringIO.StringIO(), still holding the steps taken if the optimizer raises
+    # params_perturbed: the starting parameters
+    # fs, func_exec, pts, lower_bound, upper_bound, maxiter: as passed to optimize_log_fmin
+    #--------------------------------------------------------------------------------------
+    stdout = sys.stdout
+    sys.stdout = trace
+    try:
+        return dadi.Inference.optimize_log_fmin(params_perturbed, fs, func_exec, pts, lower_bound=lower_bound, upper_bound=upper_bound, verbose=1, maxiter=maxiter, output_file=None)
+    finally:
+        sys.stdout = stdout
+
+def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_number, reps=None, maxiters=None, folds=None, in_params=None, in_upper=None, in_lower=None, param_labels=" ", cache_size=10, cache_dir=None, cache_dir_mb=1000, seed=None):
     #--------------------------------------------------------------------------------------
     # Mandatory Arguments =
     #(1) fs:  spectrum object name
@@ -187,6 +367,11 @@ def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_numbe
     #(12) in_upper: a list of upper bound values
     #(13) in_lower: a list of lower bound values
     #(14) param_labels: list of labels for parameters that will be written to the output file to keep track of their order
+    #(15) cache_size: number of model spectra kept in memory so repeated evaluations are not integrated again (default 10, 0 turns this off)
+    #(16) cache_dir: a directory where model spectra are also saved, so later runs and other scripts can reuse them (default None)
+    #(17) cache_dir_mb: size limit in megabytes for cache_dir, the least recently used spectra are removed past this (default 1000)
+    #(18) seed: integer the starting parameters of every replicate are derived from, so a run can be repeated exactly
+    #     (default None draws one from numpy's random number generator), written to the log file
     #--------------------------------------------------------------------------------------
 
     #call function that determines if our params and bounds have been set or need to be generated for us
@@ -206,6 +391,14 @@ def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_numbe
     
     #Create list to store sublists of [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values] for every replicate
     results_list = []
+
+    #every replicate gets its own random number stream derived from this seed
+    if seed is None:
+        seed = numpy.random.randint(0, 2**31 - 1)
+    seed = int(seed)
+    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
+    fh_log.write("\nSeed = {}\n".format(seed))
+    fh_log.close()
     
     #for every round, execute the assigned number of replicates with other round-defined args (maxiter, fold, best_params)
     rounds = int(rounds)
@@ -226,15 +419,18 @@ def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_numbe
             #keep track of start time for rep
             tb_rep = datetime.now()
             
-            #create an extrapolating function 
-            func_exec = dadi.Numerics.make_extrap_log_func(func)
+            #create an extrapolating function, the final step of the optimizer is cached so the simulation below is not repeated
+            func_exec = make_cached_extrap_func(func, cache_size, cache_dir=cache_dir, cache_dir_mb=cache_dir_mb)
 
             
-            #perturb starting parameters
+            #perturb starting parameters, from a stream of their own so any replicate can be repeated on its own
+            rep_seed = derive_seed(seed, r+1, rep)
+            numpy.random.seed(rep_seed)
             params_perturbed = dadi.Misc.perturb_params(best_params, fold=folds_list[r], upper_bound=upper_bound, lower_bound=lower_bound)
 
-            #optimize from perturbed parameters
-            params_opt = dadi.Inference.optimize_log_fmin(params_perturbed, fs, func_exec, pts, lower_bound=lower_bound, upper_bound=upper_bound, verbose=1, maxiter=maxiters_list[r], output_file = "{}.log.txt".format(model_name))
+            #optimize from perturbed parameters, keeping the steps of the optimizer in memory rather than in a file simulations running at the same time would share
+            trace = cStringIO.StringIO()
+            params_opt = optimize_in_memory(trace, params_perturbed, fs, func_exec, pts, lower_bound, upper_bound, maxiters_list[r])
             print "\t\t\tOptimized parameters = ", params_opt
 
             #simulate the model with the optimized parameters
@@ -244,8 +440,8 @@ def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_numbe
             roundrep = "Round_{0}_Replicate_{1}".format(r+1, rep)
             rep_results = collect_results(fs, sim_model, params_opt, roundrep)
             
-            #reproduce replicate log to bigger log file, because constantly re-written
-            write_log(outfile, model_name, rep_results, roundrep)
+            #add the optimizer steps of this replicate to the bigger log file
+            write_log(outfile, model_name, rep_results, roundrep, trace.getvalue(), rep_seed)
             
             #append results from this sim to larger list
             results_list.append(rep_results)
@@ -272,16 +468,13 @@ def Optimize_Routine_GOF(fs, pts, outfile, model_name, func, rounds, param_numbe
     te_round = tf_round - tb_round
     print "\n{0} Analysis Time: {1} (H:M:S)\n\n============================================================================".format(outfile, te_round)
 
-    #cleanup file
-    os.remove("{}.log.txt".format(model_name))
-
     #most important - sort the results list to find the top replicate for this simulation and return it to use
     results_list.sort(key=lambda x: float(x[1]), reverse=True)
     #remember the format of this list: [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
     return results_list[0]
 
 
-def Optimize_Empirical(fs, pts, outfile, model_name, func, in_params):
+def Optimize_Empirical(fs, pts, outfile, model_name, func, in_params, cache_size=10, cache_dir=None, cache_dir_mb=1000):
     #--------------------------------------------------------------------------------------
     # Mandatory Arguments =
     #(1) fs:  spectrum object name
@@ -290,6 +483,11 @@ def Optimize_Empirical(fs, pts, outfile, model_name, func, in_params):
     #(4) model_name: a label to slap on the output files; ex. "no_mig"
     #(5) func: access the model function from within script or from a separate python model script, ex. Models_2D.no_mig
     #(6) in_params: the previously optimized parameters to use
+
+    # Optional Arguments =
+    #(7) cache_size: number of model spectra kept in memory so repeated evaluations are not integrated again (default 10, 0 turns this off)
+    #(8) cache_dir: a directory where model spectra are also saved, so later runs and other scripts can reuse them (default None)
+    #(9) cache_dir_mb: size limit in megabytes for cache_dir, the least recently used spectra are removed past this (default 1000)
     #--------------------------------------------------------------------------------------
     
     print "============================================================================\nFitting model '{}' to empirical data...\n============================================================================\n".format(model_name)
@@ -301,7 +499,7 @@ def Optimize_Empirical(fs, pts, outfile, model_name, func, in_params):
     fh_out.write("Model"+'\t'+"Replicate"+'\t'+"log-likelihood"+'\t'+"theta"+'\t'+"sfs_sum"+'\t'+"chi-squared"+'\n')
     
     #create an extrapolating function 
-    func_exec = dadi.Numerics.make_extrap_log_func(func)
+    func_exec = make_cached_extrap_func(func, cache_size, cache_dir=cache_dir, cache_dir_mb=cache_dir_mb)
 
     #simulate the model with the optimized parameters
     sim_model = func_exec(in_params, fs.sample_sizes, pts)
@@ -324,7 +522,63 @@ def Optimize_Empirical(fs, pts, outfile, model_name, func, in_params):
     return folded_scaled_model
     
 
-def Perform_Sims(sim_number, model_fs, pts, model_name, func, rounds, param_number, reps=None, maxiters=None, folds=None, in_params=None, in_upper=None, in_lower=None, param_labels=" "):
+def derive_seed(seed, *keys):
+    #--------------------------------------------------------------------------------------
+    # combine a seed with labels (ex. a simulation number) into a new, independent seed for numpy.random.seed
+    
+    # Arguments
+    # seed: the seed everything else is derived from
+    # keys: any number of labels identifying the stream, ex. 3 for simulation number 3
+    #--------------------------------------------------------------------------------------
+    return int(hashlib.md5(",".join(str(x) for x in (seed,) + keys)).hexdigest()[:8], 16)
+
+def run_simulation(sim_job):
+    #--------------------------------------------------------------------------------------
+    # create one simulated data set from the model spectrum and optimize it, returning [simulation number, best replicate]
+    # this is the unit of work handed to the worker pool when Perform_Sims is given workers
+    
+    # Arguments
+    # sim_job: dictionary with the keys below, built by Perform_Sims
+    #   sim: the simulation number
+    #   seed: the seed for this simulation, the Poisson sampling and the optimization each derive their own stream from it
+    #   model_fs, pts, model_name, func, rounds, param_number, reps, maxiters, folds, in_params, in_upper, in_lower, param_labels:
+    #   as passed to Perform_Sims
+    #--------------------------------------------------------------------------------------
+    #give every simulation its own random number stream, so results don't depend on which process runs it
+    numpy.random.seed(derive_seed(sim_job['seed'], "sample"))
+
+    #create the simulated data
+    sim_fs = sim_job['model_fs'].sample()
+
+    #prefix for output file naming
+    outfile = "Simulation_{}".format(sim_job['sim'])
+    print "\n\n============================================================================\n{}\n============================================================================".format(outfile)
+
+    #optimize the simulated SFS
+    best_rep = Optimize_Routine_GOF(sim_fs, sim_job['pts'], outfile, sim_job['model_name'], sim_job['func'], sim_job['rounds'], sim_job['param_number'], reps=sim_job['reps'], maxiters=sim_job['maxiters'], folds=sim_job['folds'], in_params=sim_job['in_params'], in_upper=sim_job['in_upper'], in_lower=sim_job['in_lower'], param_labels=sim_job['param_labels'], seed=sim_job['seed'])
+
+    return [sim_job['sim'], best_rep]
+
+def write_sim_results(sim_out, previous, sim_rows):
+    #--------------------------------------------------------------------------------------
+    # rewrite the simulation results file with the rows sorted by simulation number, writing to a
+    # temporary file and moving it into place so the file is never left half written
+    
+    # Arguments
+    # sim_out: name of the results file
+    # previous: text of an earlier run that is kept as it was, above the results of this run
+    # sim_rows: dictionary of result rows keyed on simulation number
+    #--------------------------------------------------------------------------------------
+    tempname = "{}.tmp".format(sim_out)
+    fh_out = open(tempname, 'w')
+    fh_out.write(previous)
+    fh_out.write("Simulation"+'\t'+"Best_Replicate"+'\t'+"log-likelihood"+'\t'+"theta"+'\t'+"sfs_sum"+'\t'+"chi-squared"+'\t'+"optimized_params"+'\t'+"seed"+'\n')
+    for i in sorted(sim_rows):
+        fh_out.write(sim_rows[i])
+    fh_out.close()
+    os.rename(tempname, sim_out)
+
+def Perform_Sims(sim_number, model_fs, pts, model_name, func, rounds, param_number, reps=None, maxiters=None, folds=None, in_params=None, in_upper=None, in_lower=None, param_labels=" ", workers=None, seed=None, resume=False):
     #--------------------------------------------------------------------------------------
 	# Mandatory Arguments =
 		#(1) sim_number: the number of simulations to perform
@@ -339,34 +593,417 @@ def Perform_Sims(sim_number, model_fs, pts, model_name, func, rounds, param_numb
 		 # reps: a list of integers controlling the number of replicates in each of the optimization rounds
 		 # maxiters: a list of integers controlling the maxiter argument in each of the optimization rounds
 		 # folds: a list of integers controlling the fold argument when perturbing input parameter values
+		 # workers: number of processes used to run simulations in parallel (default None runs them one at a time);
+		 #          func must then be defined at the top level of a script or module so it can be sent to the worker processes
+		 # seed: integer the random number stream of every simulation is derived from, so the simulations can be
+		 #       reproduced (default None draws one from numpy's random number generator); it is written in the
+		 #       last column of Simulation_Results.txt
+		 # resume: if True, simulations of the last run in Simulation_Results.txt are not run again, and the
+		 #         seed of that run is used unless another one is given
     #--------------------------------------------------------------------------------------
 
     #Define number of simulations to perform
     sims = int(sim_number)
 
     #Output file information
+    #when resuming, rows of simulations the last run already finished are read back in and kept in order with the new ones,
+    #otherwise the new results are added below whatever is already in the file
     sim_out = "Simulation_Results.txt"
-    fh_out = open(sim_out, 'a')
-    fh_out.write("Simulation"+'\t'+"Best_Replicate"+'\t'+"log-likelihood"+'\t'+"theta"+'\t'+"sfs_sum"+'\t'+"chi-squared"+'\t'+"optimized_params"+'\n')
-    fh_out.close()
-
-    #Simulate data sets and optimize each using the general optimization routine
+    previous = ""
+    sim_rows = {}
+    if os.path.exists(sim_out):
+        fh_in = open(sim_out, 'r')
+        previous = fh_in.read()
+        fh_in.close()
+        if resume:
+            #the last run is the rows below the last header line
+            last_run = previous.rfind("Simulation\t")
+            last_seed = None
+            for line in previous[last_run:].splitlines(True):
+                line_items = line.rstrip('\n').split('\t')
+                #skip header lines and any row cut short
+                if len(line_items) == 8 and line_items[0].isdigit() and line_items[7].isdigit() and line.endswith('\n'):
+                    sim_rows[int(line_items[0])] = line
+                    last_seed = int(line_items[7])
+            if seed is None:
+                seed = last_seed
+            #results made with another seed are kept as they are, above the new run
+            if sim_rows and seed == last_seed:
+                previous = previous[:last_run]
+                print "Resuming, {0} simulations already in {1}\n".format(len(sim_rows), sim_out)
+            else:
+                sim_rows = {}
+
+    #every simulation gets its own seed derived from this one
+    if seed is None:
+        seed = numpy.random.randint(0, 2**31 - 1)
+    print "\nSeed used to derive the random number stream of each simulation = {}\n".format(seed)
+
+    #set up a job for each simulation still to be run
+    sim_jobs = []
     for i in range(1,(sims+1)):
-        fh_out = open(sim_out, 'a')
-
-        #create the simulated data
-        sim_fs = model_fs.sample()
-
-        #prefix for output file naming
-        outfile = "Simulation_{}".format(i)
-        print "\n\n============================================================================\n{}\n============================================================================".format(outfile)
-
-        #optimize the simulated SFS
-        best_rep = Optimize_Routine_GOF(sim_fs, pts, outfile, model_name, func, rounds, param_number, reps, maxiters)
+        if i in sim_rows:
+            continue
+        sim_jobs.append({'sim':i, 'seed':derive_seed(seed, i), 'model_fs':model_fs, 'pts':pts, 'model_name':model_name,
+                         'func':func, 'rounds':rounds, 'param_number':param_number, 'reps':reps, 'maxiters':maxiters,
+                         'folds':folds, 'in_params':in_params, 'in_upper':in_upper, 'in_lower':in_lower, 'param_labels':param_labels})
+
+    #Simulate data sets and optimize each using the general optimization routine, serially or through the worker pool
+    if workers is None:
+        pool = None
+        sim_iter = itertools.imap(run_simulation, sim_jobs)
+    else:
+        pool = multiprocessing.Pool(int(workers))
+        sim_iter = pool.imap_unordered(run_simulation, sim_jobs)
 
+    for i, best_rep in sim_iter:
         easy_params = ",".join(str(numpy.around(x, 4)) for x in best_rep[5])
 
         #list is [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values, sfs_sum]
         #add result for this simulation to output file
-        fh_out.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(i,best_rep[0],best_rep[1],best_rep[4],best_rep[6],best_rep[3],easy_params))
-        fh_out.close()
+        sim_rows[i] = "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n".format(i,best_rep[0],best_rep[1],best_rep[4],best_rep[6],best_rep[3],easy_params,seed)
+        write_sim_results(sim_out, previous, sim_rows)
+
+    #shut down the worker processes
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+#tables of projection coefficients made by projection_table, keyed on projection size, shared by every SNP and spectrum
+_projection_tables = {}
+
+def snps_file_signature(snps):
+    #--------------------------------------------------------------------------------------
+    # return [size, modification time, hash of the first megabyte] of a SNPs file, used to tell
+    # whether the binary copy made by Load_SNPs is still up to date
+    
+    # Arguments
+    # snps: path to the SNPs file
+    #--------------------------------------------------------------------------------------
+    stat = os.stat(snps)
+    fh_snps = open(snps, 'rb')
+    head = fh_snps.read(2**20)
+    fh_snps.close()
+    return [stat.st_size, stat.st_mtime, hashlib.sha1(head).hexdigest()]
+
+def parse_snps_chunk(lines, allele2_index, npops):
+    #--------------------------------------------------------------------------------------
+    # convert lines of a SNPs file (in the format read by dadi.Misc.make_data_dict) to arrays, returning
+    # [allele1 calls, allele2 calls, polarity], where the calls have one column per population and polarity
+    # is 1 if the outgroup allele is Allele1, 2 if it is Allele2, and 0 if the SNP can't be polarized
+    
+    # Arguments
+    # lines: list of lines from the SNPs file, without the header or comment lines
+    # allele2_index: index of the Allele2 column
+    # npops: number of populations in the file
+    #--------------------------------------------------------------------------------------
+    rows = numpy.array([line.split()[:allele2_index+npops+1] for line in lines])
+    calls1 = rows[:, 3:allele2_index].astype(numpy.int32)
+    calls2 = rows[:, allele2_index+1:].astype(numpy.int32)
+    #the outgroup allele is the middle base of the outgroup context, ex. "A" for "CAT"
+    outgroup = numpy.char.upper(numpy.ascontiguousarray(rows[:, 1]).view('S1').reshape(len(rows), -1)[:, 1])
+    allele1 = numpy.char.upper(rows[:, 2])
+    allele2 = numpy.char.upper(rows[:, allele2_index])
+    polarity = numpy.zeros(len(rows), dtype=numpy.int8)
+    polarity[outgroup == allele2] = 2
+    polarity[outgroup == allele1] = 1
+    polarity[outgroup == '-'] = 0
+    return [calls1, calls2, polarity]
+
+def open_snps_file(snps):
+    #--------------------------------------------------------------------------------------
+    # open a SNPs file (optionally gzipped) and return [file handle, index of the Allele2 column, population names],
+    # with the file handle positioned after the header
+    
+    # Arguments
+    # snps: path to the SNPs file
+    #--------------------------------------------------------------------------------------
+    if snps.endswith('.gz'):
+        fh_snps = gzip.open(snps)
+    else:
+        fh_snps = open(snps)
+    # Skip to the header
+    header = fh_snps.readline()
+    while header.startswith('#'):
+        header = fh_snps.readline()
+    allele2_index = header.split().index('Allele2')
+    pop_ids = header.split()[3:allele2_index]
+    return [fh_snps, allele2_index, pop_ids]
+
+def superseded_snp_lines(snps, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # return the set of SNP lines (numbered from 0, not counting the header, comments and blank lines) that
+    # dadi.Misc.make_data_dict leaves out, because a later line has the same name in the columns after
+    # the Allele2 calls (usually Gene and Position) and replaces it in the dictionary;
+    # rather than a dictionary of every name, only a 64-bit hash of each name is kept (8 bytes per SNP,
+    # about 16 bytes per SNP at the peak while the hashes are sorted, ex. ~160 MB for 10 million SNPs),
+    # repeated hashes are found by sorting, and the names of just those lines are read again and compared,
+    # so two names that happen to share a hash are not mistaken for each other
+    
+    # Arguments
+    # snps: path to the SNPs file
+    # chunk_size: number of lines hashed at a time
+    #--------------------------------------------------------------------------------------
+    fh_snps, allele2_index, pop_ids = open_snps_file(snps)
+    name_start = allele2_index + len(pop_ids) + 1
+
+    def snp_names(fh_snps):
+        for line in fh_snps:
+            if line.strip() and not line.startswith('#'):
+                yield '_'.join(line.split()[name_start:])
+
+    #make_data_dict names unnamed SNPs by their line, so those are never replaced
+    hash_chunks = []
+    named_chunks = []
+    names = snp_names(fh_snps)
+    for chunk in iter(lambda: list(itertools.islice(names, chunk_size)), []):
+        hash_chunks.append(numpy.fromiter((hash(snp_id) for snp_id in chunk), dtype=numpy.int64, count=len(chunk)))
+        named_chunks.append(numpy.fromiter((bool(snp_id) for snp_id in chunk), dtype=bool, count=len(chunk)))
+    fh_snps.close()
+    if not hash_chunks:
+        return set()
+    hashes = numpy.concatenate(hash_chunks)
+    named = numpy.concatenate(named_chunks)
+    del hash_chunks, named_chunks
+
+    sorted_hashes = numpy.sort(hashes[named])
+    repeated = numpy.unique(sorted_hashes[1:][sorted_hashes[1:] == sorted_hashes[:-1]])
+    del sorted_hashes
+    if len(repeated) == 0:
+        return set()
+    candidates = set(numpy.nonzero(named & numpy.in1d(hashes, repeated))[0].tolist())
+    del hashes, named
+
+    #the lines that may share a name are read again, to compare the names themselves
+    fh_snps, allele2_index, pop_ids = open_snps_file(snps)
+    last_line = {}
+    superseded = set()
+    for line_number, snp_id in enumerate(snp_names(fh_snps)):
+        if line_number in candidates:
+            if snp_id in last_line:
+                superseded.add(last_line[snp_id])
+            last_line[snp_id] = line_number
+    fh_snps.close()
+    return superseded
+
+def read_snps_file(snps, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # open a SNPs file (the format used by dadi.Misc.make_data_dict, optionally gzipped) and return
+    # [population names, iterator], where the iterator gives the arrays made by parse_snps_chunk
+    # for chunk_size lines at a time, so the whole file is never held in memory; as with make_data_dict,
+    # only the last of several lines with the same Gene and Position is used (see superseded_snp_lines)
+    
+    # Arguments
+    # snps: path to the SNPs file
+    # chunk_size: number of lines parsed at a time
+    #--------------------------------------------------------------------------------------
+    superseded = superseded_snp_lines(snps, chunk_size)
+    if superseded:
+        print "{0} lines of {1} are left out, a later line has the same Gene and Position".format(len(superseded), snps)
+    fh_snps, allele2_index, pop_ids = open_snps_file(snps)
+
+    def chunks():
+        line_number = 0
+        for lines in iter(lambda: list(itertools.islice(fh_snps, chunk_size)), []):
+            lines = [line for line in lines if line.strip() and not line.startswith('#')]
+            if superseded:
+                kept = [line for i, line in enumerate(lines, line_number) if i not in superseded]
+            else:
+                kept = lines
+            line_number += len(lines)
+            if kept:
+                yield parse_snps_chunk(kept, allele2_index, len(pop_ids))
+        fh_snps.close()
+    return [pop_ids, chunks()]
+
+def Load_SNPs(snps, cache_dir=None, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # read a SNPs file (the format used by dadi.Misc.make_data_dict) into a dictionary of arrays:
+    #   pop_ids: population names, in the order of the file columns
+    #   calls1, calls2: number of Allele1 and Allele2 calls for each SNP (rows) and population (columns)
+    #   polarity: 1 if the outgroup allele is Allele1, 2 if it is Allele2, 0 if the SNP can't be polarized
+    # the first time a file is read it is parsed in chunks and the arrays are saved in cache_dir, after
+    # that they are memory-mapped from there, until the size, modification time or first megabyte of the file changes;
+    # if cache_dir can't be written to (ex. a read-only data directory), the path of the SNPs file is returned instead,
+    # which Spectrum_From_SNPs then reads through again each time
+    
+    # Arguments
+    # snps: path to the SNPs file
+    # cache_dir: directory for the binary copy of the SNPs file (default None uses "snps.cache" next to the file)
+    # chunk_size: number of lines parsed at a time, which limits the memory used while parsing
+    #--------------------------------------------------------------------------------------
+    if cache_dir is None:
+        cache_dir = "{}.cache".format(snps)
+    index_name = os.path.join(cache_dir, "index.pkl")
+    signature = snps_file_signature(snps)
+
+    #use the binary copy if it was made from this version of the file
+    index = None
+    if os.path.exists(index_name):
+        fh_index = open(index_name, 'rb')
+        index = cPickle.load(fh_index)
+        fh_index.close()
+        if index['signature'] != signature:
+            index = None
+
+    if index is None:
+        print "\nParsing {0}, saving the allele counts to {1}".format(snps, cache_dir)
+        tb_parse = datetime.now()
+        names = ['calls1', 'calls2', 'polarity']
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            pop_ids, snp_chunks = read_snps_file(snps, chunk_size)
+
+            #each array is written out a chunk at a time as raw binary, to temporary files named for this process
+            #so that several jobs parsing the same file at once don't write over each other's copies
+            tag = "{0}.{1}".format(os.getpid(), uuid.uuid4().hex)
+            fh_bins = [open(os.path.join(cache_dir, "{0}.bin.{1}.tmp".format(x, tag)), 'wb') for x in names]
+            nsnps = 0
+            for chunk in snp_chunks:
+                for fh_bin, array in zip(fh_bins, chunk):
+                    array.tofile(fh_bin)
+                nsnps += len(chunk[2])
+            for fh_bin, name in zip(fh_bins, names):
+                fh_bin.close()
+                os.rename(os.path.join(cache_dir, "{0}.bin.{1}.tmp".format(name, tag)), os.path.join(cache_dir, "{}.bin".format(name)))
+
+            #the index is written last, so a copy is only used once it is complete
+            index = {'signature':signature, 'pop_ids':pop_ids, 'nsnps':nsnps}
+            fh_index = open("{0}.{1}.tmp".format(index_name, tag), 'wb')
+            cPickle.dump(index, fh_index, 2)
+            fh_index.close()
+            os.rename("{0}.{1}.tmp".format(index_name, tag), index_name)
+        #without somewhere to keep the binary copy, the SNPs file is read through each time it is used instead
+        except (OSError, IOError) as error:
+            print "Could not save the allele counts to {0} ({1}), {2} will be read again each time it is used\n".format(cache_dir, error, snps)
+            return snps
+        print "Parsed {0} SNPs in {1} (H:M:S)\n".format(nsnps, datetime.now() - tb_parse)
+
+    snp_data = {'pop_ids':index['pop_ids']}
+    npops = len(index['pop_ids'])
+    for name, dtype, shape in [('calls1', numpy.int32, (index['nsnps'], npops)), ('calls2', numpy.int32, (index['nsnps'], npops)), ('polarity', numpy.int8, (index['nsnps'],))]:
+        if index['nsnps'] == 0:
+            snp_data[name] = numpy.zeros(shape, dtype=dtype)
+        else:
+            snp_data[name] = numpy.memmap(os.path.join(cache_dir, "{}.bin".format(name)), dtype=dtype, mode='r', shape=shape)
+    return snp_data
+
+def log_comb(n, k):
+    #--------------------------------------------------------------------------------------
+    # log of n choose k for arrays of n and k, -inf where k is below 0 or above n
+    #--------------------------------------------------------------------------------------
+    n, k = numpy.broadcast_arrays(numpy.asarray(n, dtype=float), numpy.asarray(k, dtype=float))
+    result = numpy.full(n.shape, -numpy.inf)
+    valid = (k >= 0) & (k <= n)
+    result[valid] = gammaln(n[valid]+1) - gammaln(k[valid]+1) - gammaln(n[valid]-k[valid]+1)
+    return result
+
+def projection_table(proj_to, max_called):
+    #--------------------------------------------------------------------------------------
+    # return the table W[called, derived, j] of hypergeometric probabilities of seeing j derived alleles when
+    # proj_to alleles are drawn from the alleles called, of which derived are derived, for every number of alleles
+    # called up to at least max_called (zero where fewer than proj_to alleles were called)
+    # the table is made once per projection size and reused for every SNP and every spectrum after that
+    
+    # Arguments
+    # proj_to: the projection size
+    # max_called: largest number of alleles called for any SNP
+    #--------------------------------------------------------------------------------------
+    if proj_to not in _projection_tables or len(_projection_tables[proj_to]) <= max_called:
+        called, derived, proj_hits = numpy.ogrid[0:max_called+1, 0:max_called+1, 0:proj_to+1]
+        #worked out in logs so large sample sizes don't overflow, impossible draws come out as exp(-inf) = 0
+        old_settings = numpy.seterr(invalid='ignore', under='ignore')
+        table = numpy.exp(log_comb(proj_to, proj_hits) + log_comb(called-proj_to, derived-proj_hits) - log_comb(called, derived))
+        numpy.seterr(**old_settings)
+        table[numpy.isnan(table) | (numpy.broadcast_to(called, table.shape) < proj_to)] = 0.
+        _projection_tables[proj_to] = table
+    return _projection_tables[proj_to]
+
+def count_snp_patterns(called, derived):
+    #--------------------------------------------------------------------------------------
+    # collapse SNPs with the same alleles called and derived alleles called in every population into one pattern,
+    # returning [called, derived, counts] with one row per distinct pattern and the number of SNPs sharing it,
+    # so the projection work depends on the number of distinct patterns rather than the number of SNPs
+    
+    # Arguments
+    # called: alleles called for each SNP (rows) and population (columns)
+    # derived: derived alleles called for each SNP (rows) and population (columns)
+    #--------------------------------------------------------------------------------------
+    npops = called.shape[1]
+    snp_patterns = numpy.hstack([called, derived])
+    #sorting one number per SNP is much faster than sorting rows, so each pattern is packed into a single
+    #integer when it fits, with a digit in base (most alleles called + 1) for each column
+    base = int(snp_patterns.max()) + 1
+    if base ** snp_patterns.shape[1] < 2**62:
+        keys = numpy.zeros(len(snp_patterns), dtype=numpy.int64)
+        for column in snp_patterns.T:
+            keys = keys * base + column
+        keys, first, counts = numpy.unique(keys, return_index=True, return_counts=True)
+        patterns = snp_patterns[first]
+    else:
+        patterns, counts = numpy.unique(snp_patterns, axis=0, return_counts=True)
+    return [patterns[:, :npops], patterns[:, npops:], counts]
+
+def add_snps_to_spectrum(fs_total, calls1, calls2, polarity, projections, polarized):
+    #--------------------------------------------------------------------------------------
+    # project a chunk of SNPs down to the projection sizes and add them to a spectrum array, in place
+    
+    # Arguments
+    # fs_total: array of shape projections+1 the SNPs are added to
+    # calls1, calls2: Allele1 and Allele2 calls of the SNPs, one column per population in the order of projections
+    # polarity: 1 if the outgroup allele is Allele1, 2 if it is Allele2, 0 if the SNP can't be polarized
+    # projections: projection sizes, in ALLELES not individuals, one per population
+    # polarized: if True, SNPs that can't be polarized are left out
+    #--------------------------------------------------------------------------------------
+    #the derived allele is the one that differs from the outgroup, or Allele2 if the SNP isn't polarized
+    called = calls1 + calls2
+    derived = numpy.where((polarity == 2)[:, numpy.newaxis], calls1, calls2)
+
+    if polarized:
+        called, derived = called[polarity != 0], derived[polarity != 0]
+    if len(called) == 0:
+        return
+    called, derived, counts = count_snp_patterns(called, derived)
+
+    #look up the projection coefficients of every pattern in each population, and add the products across
+    #populations of all the patterns, times their counts, to the spectrum at once, ex. "za,zb->ab" for two populations
+    max_called = int(called.max())
+    weights = [projection_table(proj_to, max_called)[called[:, i], derived[:, i]] for i, proj_to in enumerate(projections)]
+    weights[0] = weights[0] * counts[:, numpy.newaxis]
+    pop_letters = "abcdefghij"[:len(projections)]
+    subscripts = "{0}->{1}".format(",".join("z"+x for x in pop_letters), pop_letters)
+    fs_total += numpy.einsum(subscripts, *weights, optimize=True)
+
+def Spectrum_From_SNPs(snp_data, pop_ids, projections, polarized=True, mask_corners=True, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # build a frequency spectrum from a SNPs file, giving the same spectrum as
+    # dadi.Spectrum.from_data_dict(dadi.Misc.make_data_dict(snps), pop_ids, projections, mask_corners, polarized),
+    # including leaving out lines replaced by a later line with the same Gene and Position
+    # the SNPs are projected and added to the spectrum chunk_size at a time, so the memory used
+    # depends on the chunk size rather than the number of SNPs
+    
+    # Arguments
+    # snp_data: the dictionary returned by Load_SNPs, or the path to a SNPs file to stream through without saving a binary copy
+    # pop_ids: list of the populations to include, which should match the population headers of the SNPs file
+    # projections: projection sizes, in ALLELES not individuals, one per population
+    # polarized: if True, only SNPs polarized by the outgroup are used; if False, all are used and the spectrum is folded
+    # mask_corners: if True, the 'observed in none' and 'observed in all' entries of the spectrum are masked
+    # chunk_size: number of SNPs projected at a time
+    #--------------------------------------------------------------------------------------
+    if isinstance(snp_data, basestring):
+        file_pop_ids, snp_chunks = read_snps_file(snp_data, chunk_size)
+    else:
+        file_pop_ids = snp_data['pop_ids']
+        nsnps = len(snp_data['polarity'])
+        snp_chunks = ([snp_data['calls1'][i:i+chunk_size], snp_data['calls2'][i:i+chunk_size], snp_data['polarity'][i:i+chunk_size]] for i in xrange(0, nsnps, chunk_size))
+    cols = [file_pop_ids.index(pop) for pop in pop_ids]
+
+    fs_total = numpy.zeros(numpy.array(projections)+1)
+    for calls1, calls2, polarity in snp_chunks:
+        add_snps_to_spectrum(fs_total, numpy.asarray(calls1)[:, cols], numpy.asarray(calls2)[:, cols], numpy.asarray(polarity), projections, polarized)
+
+    fs = dadi.Spectrum(fs_total, mask_corners=mask_corners, pop_ids=pop_ids)
+    if not polarized:
+        fs = fs.fold()
+    return fs
@@ -48,12 +48,12 @@ Outputs:
  for each is written to a tab-delimited file called Simulation_Results.txt. Here is an 
  example of the contents for this file:
  
- Simulation	Best_Replicate	log-likelihood	theta	sfs_sum	chi-squared	optimized_params
- 1	Round_3_Replicate_2	-162.23	1205.59	1628.0	218.38	0.0333,0.0338,0.4525,0.9208
- 2	Round_3_Replicate_2	-186.49	1079.25	1588.0	271.11	0.0431,0.0427,0.4401,1.3532
- 3	Round_3_Replicate_3	-225.82	650.49	1565.0	560.88	0.0997,0.1129,0.1136,1.0299
- 4	Round_3_Replicate_2	-361.47	1279.59	1567.0	1369.01	0.0101,0.0478,0.5306,4.452
- 5	Round_3_Replicate_1	-221.84	73.7	1492.0	518.56	0.5149,0.8345,0.0214,23.2449
+ Simulation	Best_Replicate	log-likelihood	theta	sfs_sum	chi-squared	optimized_params	seed
+ 1	Round_3_Replicate_2	-162.23	1205.59	1628.0	218.38	0.0333,0.0338,0.4525,0.9208	12345
+ 2	Round_3_Replicate_2	-186.49	1079.25	1588.0	271.11	0.0431,0.0427,0.4401,1.3532	12345
+ 3	Round_3_Replicate_3	-225.82	650.49	1565.0	560.88	0.0997,0.1129,0.1136,1.0299	12345
+ 4	Round_3_Replicate_2	-361.47	1279.59	1567.0	1369.01	0.0101,0.0478,0.5306,4.452	12345
+ 5	Round_3_Replicate_1	-221.84	73.7	1492.0	518.56	0.5149,0.8345,0.0214,23.2449	12345
 
 
 Notes/Caveats:
@@ -104,8 +104,15 @@ Updated May 2018
 #**************
 snps = "/Users/dan/Dropbox/dadi_inputs/General_Script/dadi_2pops_North_South_snps.txt"
 
-#Create python dictionary from snps file
-dd = dadi.Misc.make_data_dict(snps)
+#**************
+#folder for a binary copy of the snps file, None puts it next to the snps file (as "snps.cache"),
+#give a folder you can write to if the snps file is in a read-only or shared directory
+cache_dir = None
+
+#Read the allele counts from the snps file, the first time a binary copy is saved in cache_dir,
+#which later runs load instead for as long as the snps file is unchanged; if the copy can't be
+#saved, the snps file is read through again whenever it is used
+snp_data = Optimize_Functions_GOF.Load_SNPs(snps, cache_dir=cache_dir)
 
 #**************
 #pop_ids is a list which should match the populations headers of your SNPs file columns
@@ -115,9 +122,9 @@ pop_ids=["North", "South"]
 #projection sizes, in ALLELES not individuals
 proj = [16,32]
 
-#Convert this dictionary into folded AFS object
+#Convert the allele counts into folded AFS object
 #[polarized = False] creates folded spectrum object
-fs = dadi.Spectrum.from_data_dict(dd, pop_ids=pop_ids, projections = proj, polarized = False)
+fs = Optimize_Functions_GOF.Spectrum_From_SNPs(snp_data, pop_ids=pop_ids, projections = proj, polarized = False)
 
 #print some useful information about the afs or jsfs
 print "\n\n============================================================================\nData for site frequency spectrum\n============================================================================\n"
@@ -201,6 +208,10 @@ Optional Arguments =
      reps: a list of integers controlling the number of replicates in each of the optimization rounds
      maxiters: a list of integers controlling the maxiter argument in each of the optimization rounds
      folds: a list of integers controlling the fold argument when perturbing input parameter values
+     workers: number of processes used to run simulations in parallel (default None runs them one at a time)
+     seed: integer the random number stream of every simulation is derived from, to make the simulations reproducible (default None)
+     resume: if True, simulations the last run already wrote to Simulation_Results.txt are skipped when the script is run again,
+             using the seed of that run unless another is given (default False)
 '''
 
 #**************
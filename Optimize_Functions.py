@@ -1,9 +1,525 @@
 import sys
 import os
+import itertools
+import collections
+import heapq
+import traceback
+import hashlib
+import uuid
+import inspect
+import json
+import gzip
+import multiprocessing
+import cPickle
+import cStringIO
+import sqlite3
+import time
 import numpy
+from scipy.special import gammaln
 import dadi
 from datetime import datetime
 
+def evaluate_grid(grid_job):
+    #--------------------------------------------------------------------------------------
+    # evaluate a model at a single grid size, this is what make_parallel_extrap_log_func sends to its pool
+    
+    # Arguments
+    # grid_job: tuple of (model function, params, ns, grid size)
+    # returns [model spectrum, seconds taken]
+    #--------------------------------------------------------------------------------------
+    func, params, ns, pt = grid_job
+    tb_grid = time.time()
+    sim_model = func(params, ns, pt)
+    return [sim_model, time.time() - tb_grid]
+
+def make_parallel_extrap_log_func(func, grid_pool, fail_mag=10, grid_times=None):
+    #--------------------------------------------------------------------------------------
+    # the same as dadi.Numerics.make_extrap_log_func, except the model is evaluated at all of the
+    # grid sizes at once through a pool of worker processes, and then extrapolated; any number of grid sizes
+    # can be used, with more than three extrapolated by the polynomial through all of them, and a single
+    # grid size is evaluated in this process as there is nothing to run alongside it
+    
+    # Arguments
+    # func: access the model function, ex. Models_2D.no_mig
+    # grid_pool: a multiprocessing pool, ideally with one process per grid size
+    # fail_mag: as in dadi, entries extrapolated more than this many orders of magnitude away from
+    #           the result on the largest grid are replaced by that result
+    # grid_times: if given, a list the seconds taken at each grid size are appended to
+    #--------------------------------------------------------------------------------------
+    def extrap_func(params, ns, pts):
+        if numpy.isscalar(pts):
+            pts = [pts]
+        if len(pts) == 1:
+            grid_results = [evaluate_grid((func, params, ns, pts[0]))]
+        else:
+            grid_results = grid_pool.map(evaluate_grid, [(func, params, ns, pt) for pt in pts])
+        result_l = [x[0] for x in grid_results]
+        if grid_times is not None:
+            grid_times.extend(x[1] for x in grid_results)
+        if len(result_l) == 1:
+            return result_l[0]
+        x_l = [result.extrap_x for result in result_l]
+        log_l = [numpy.log(result) for result in result_l]
+        if len(result_l) == 2:
+            ex_result = numpy.exp(dadi.Numerics.linear_extrap(log_l, x_l))
+        elif len(result_l) == 3:
+            ex_result = numpy.exp(dadi.Numerics.quadratic_extrap(log_l, x_l))
+        else:
+            #the value at x = 0 of the polynomial through every (x, log result) pair, which is what the linear and
+            #quadratic extrapolations above are for two and three grid sizes
+            ex_log = 0
+            for i in range(len(result_l)):
+                weight = 1.0
+                for j in range(len(result_l)):
+                    if j != i:
+                        weight *= x_l[j] / (x_l[j] - x_l[i])
+                ex_log = ex_log + weight * log_l[i]
+            ex_result = numpy.exp(ex_log)
+
+        #guard against numerical instabilities in the extrapolation, as dadi does
+        best_result = result_l[numpy.argmin(x_l)]
+        extrap_failed = abs(numpy.log10(ex_result/best_result)) > fail_mag
+        if numpy.any(extrap_failed):
+            print "Extrapolation may have failed. Check resulting frequency spectrum for unexpected results."
+            ex_result[extrap_failed] = best_result[extrap_failed]
+        ex_result.pop_ids = result_l[0].pop_ids
+        return ex_result
+    return extrap_func
+
+#spectra cached by make_cached_extrap_func, shared by every cached function made in this process
+#so that repeated evaluations are found no matter which step of the routine asks for them
+_spectrum_cache = collections.OrderedDict()
+_spectrum_cache_stats = {'hits':0, 'misses':0}
+
+#running total of the bytes held in each on-disk spectrum cache directory, filled the first time a directory is used
+_disk_cache_bytes = {}
+#hash of the source code of each model function, so a spectrum cached on disk is not used after the model is edited
+_model_source_hashes = {}
+
+def model_source_hash(func):
+    #--------------------------------------------------------------------------------------
+    # return a hash of the source code of a model function (or of its compiled code if the source is not available)
+    
+    # Arguments
+    # func: access the model function, ex. Models_2D.no_mig
+    #--------------------------------------------------------------------------------------
+    if func not in _model_source_hashes:
+        try:
+            source = inspect.getsource(func)
+        except (IOError, TypeError):
+            source = func.func_code.co_code
+        _model_source_hashes[func] = hashlib.sha1(source).hexdigest()
+    return _model_source_hashes[func]
+
+def read_cached_spectrum(cache_dir, key):
+    #--------------------------------------------------------------------------------------
+    # return the spectrum stored on disk for this key, or None if there isn't one
+    
+    # Arguments
+    # cache_dir: directory holding the cached spectra
+    # key: the content hash naming the cached spectrum
+    #--------------------------------------------------------------------------------------
+    cachename = os.path.join(cache_dir, "{}.npz".format(key))
+    try:
+        stored = numpy.load(cachename)
+        sim_model = dadi.Spectrum(stored['data'], mask=stored['mask'], data_folded=bool(stored['folded']))
+        stored.close()
+        #mark the file as recently used so it is among the last to be evicted
+        os.utime(cachename, None)
+    except (IOError, OSError, KeyError, ValueError):
+        #missing, or removed by another run evicting files at the same time
+        return None
+    return sim_model
+
+def write_cached_spectrum(cache_dir, key, sim_model, cache_dir_mb):
+    #--------------------------------------------------------------------------------------
+    # store a spectrum on disk, then remove the least recently used spectra if the directory
+    # has grown past its size limit
+    
+    # Arguments
+    # cache_dir: directory holding the cached spectra
+    # key: the content hash naming the cached spectrum
+    # sim_model: the model spectrum
+    # cache_dir_mb: size limit for the directory in megabytes
+    #--------------------------------------------------------------------------------------
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            #made by another run in the meantime
+            pass
+    if cache_dir not in _disk_cache_bytes:
+        _disk_cache_bytes[cache_dir] = sum(os.path.getsize(os.path.join(cache_dir, x)) for x in os.listdir(cache_dir) if x.endswith(".npz"))
+
+    #write to a temporary file first so other runs never read a half written spectrum
+    cachename = os.path.join(cache_dir, "{}.npz".format(key))
+    tempname = "{0}.{1}.tmp".format(cachename, os.getpid())
+    fh_cache = open(tempname, 'wb')
+    numpy.savez(fh_cache, data=numpy.asarray(sim_model.data), mask=numpy.ma.getmaskarray(sim_model), folded=sim_model.folded)
+    fh_cache.close()
+    os.rename(tempname, cachename)
+    _disk_cache_bytes[cache_dir] += os.path.getsize(cachename)
+
+    #evict the least recently used spectra down to 90% of the limit
+    max_bytes = float(cache_dir_mb) * 1024 * 1024
+    if _disk_cache_bytes[cache_dir] > max_bytes:
+        cached = []
+        for x in os.listdir(cache_dir):
+            if x.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(cache_dir, x))
+                    cached.append([stat.st_mtime, stat.st_size, x])
+                except OSError:
+                    continue
+        cached.sort()
+        total = sum(x[1] for x in cached)
+        for mtime, size, x in cached:
+            if total <= 0.9 * max_bytes:
+                break
+            try:
+                os.remove(os.path.join(cache_dir, x))
+                total -= size
+            except OSError:
+                continue
+        _disk_cache_bytes[cache_dir] = total
+
+def make_timed_func(func, grid_times):
+    #--------------------------------------------------------------------------------------
+    # wrap a model function so the seconds taken by every call (the model at one grid size) are appended to grid_times
+    
+    # Arguments
+    # func: access the model function, ex. Models_2D.no_mig
+    # grid_times: the list the times are appended to
+    #--------------------------------------------------------------------------------------
+    def timed_func(params, ns, pts):
+        tb_grid = time.time()
+        sim_model = func(params, ns, pts)
+        grid_times.append(time.time() - tb_grid)
+        return sim_model
+    return timed_func
+
+def make_cached_extrap_func(func, cache_size=10, digits=10, cache_dir=None, cache_dir_mb=1000, grid_pool=None, grid_times=None):
+    #--------------------------------------------------------------------------------------
+    # create the extrapolating function for a model with dadi.Numerics.make_extrap_log_func, wrapped in a
+    # bounded least-recently-used cache keyed on (model, rounded params, ns, pts), so a parameter set that
+    # was already simulated on the same grid (ex. the optimizer's final step) is not integrated again
+    
+    # Arguments
+    # func: access the model function, ex. Models_2D.no_mig
+    # cache_size: the largest number of model spectra to keep, 0 or None turns the cache off
+    # digits: number of decimal places the parameters are rounded to when looking up a spectrum
+    # cache_dir: a directory where spectra are also stored as .npz files named by a hash of
+    #            (model name, model source code, rounded params, ns, pts), so they can be reused by later runs
+    # cache_dir_mb: size limit for cache_dir in megabytes, the least recently used spectra are removed past this
+    # grid_pool: if given, the grid sizes are evaluated at the same time through this pool (see make_parallel_extrap_log_func)
+    # grid_times: if given, a list the seconds taken by the model at each grid size are appended to
+    #--------------------------------------------------------------------------------------
+    if grid_pool is not None:
+        func_exec = make_parallel_extrap_log_func(func, grid_pool, grid_times=grid_times)
+    elif grid_times is not None:
+        func_exec = dadi.Numerics.make_extrap_log_func(make_timed_func(func, grid_times))
+    else:
+        func_exec = dadi.Numerics.make_extrap_log_func(func)
+    if not cache_size and cache_dir is None:
+        return func_exec
+
+    model_key = "{0}.{1}".format(func.__module__, func.__name__)
+    if cache_dir is not None:
+        model_key = "{0}.{1}".format(model_key, model_source_hash(func))
+    def cached_func_exec(params, ns, pts):
+        key = (model_key, tuple(numpy.around(params, digits)), tuple(int(n) for n in ns), tuple(pts))
+        if key in _spectrum_cache:
+            _spectrum_cache_stats['hits'] += 1
+            #move the spectrum to the most recently used end
+            sim_model = _spectrum_cache.pop(key)
+        else:
+            sim_model = None
+            if cache_dir is not None:
+                disk_key = hashlib.sha1(repr(key)).hexdigest()
+                sim_model = read_cached_spectrum(cache_dir, disk_key)
+            if sim_model is not None:
+                _spectrum_cache_stats['hits'] += 1
+            else:
+                _spectrum_cache_stats['misses'] += 1
+                sim_model = func_exec(params, ns, pts)
+                if cache_dir is not None:
+                    write_cached_spectrum(cache_dir, disk_key, sim_model, cache_dir_mb)
+        if not cache_size:
+            return sim_model
+        _spectrum_cache[key] = sim_model
+        while len(_spectrum_cache) > int(cache_size):
+            _spectrum_cache.popitem(last=False)
+        #hand back a copy so the cached spectrum can never be changed by the caller
+        return sim_model.copy()
+    return cached_func_exec
+
+def cache_info():
+    #--------------------------------------------------------------------------------------
+    # return the number of hits (in memory or on disk), misses, and spectra currently held in memory
+    # by the caches used in make_cached_extrap_func
+    #--------------------------------------------------------------------------------------
+    return _spectrum_cache_stats['hits'], _spectrum_cache_stats['misses'], len(_spectrum_cache)
+
+#best log-likelihood reached so far by any replicate of the current round, shared with the worker processes when pruning
+_round_best = None
+
+class PruneReplicate(Exception):
+    #--------------------------------------------------------------------------------------
+    # raised from inside the optimizer to stop a replicate that is clearly worse than the round's best
+    #--------------------------------------------------------------------------------------
+    pass
+
+def init_pruning(round_best):
+    #--------------------------------------------------------------------------------------
+    # store the shared best log-likelihood of the round, used as the initializer of the worker pool
+    
+    # Arguments
+    # round_best: a multiprocessing.Value holding the best log-likelihood of the current round
+    #--------------------------------------------------------------------------------------
+    global _round_best
+    _round_best = round_best
+
+def make_pruned_func(func_exec, fs, prune_factor, prune_after, monitor):
+    #--------------------------------------------------------------------------------------
+    # wrap an extrapolating function so the optimizer's progress is followed, and the replicate is stopped
+    # (by raising PruneReplicate) once its best log-likelihood falls below prune_factor times the best
+    # log-likelihood reached so far by any replicate of the round
+    
+    # Arguments
+    # func_exec: the extrapolating function used by the optimizer
+    # fs: spectrum object name
+    # prune_factor: how many times worse than the round's best a replicate must be to be stopped, ex. 2
+    # prune_after: number of model evaluations a replicate always gets before it can be stopped
+    # monitor: dictionary that is filled with the number of evaluations ('evals'), the best log-likelihood ('ll')
+    #          and the parameters that reached it ('params')
+    #--------------------------------------------------------------------------------------
+    monitor.update({'evals':0, 'll':None, 'params':None})
+    def pruned_func_exec(params, ns, pts):
+        sim_model = func_exec(params, ns, pts)
+        ll = dadi.Inference.ll_multinom(sim_model, fs)
+        monitor['evals'] += 1
+        if not numpy.isnan(ll) and (monitor['ll'] is None or ll > monitor['ll']):
+            monitor['ll'] = ll
+            monitor['params'] = numpy.array(params)
+            with _round_best.get_lock():
+                if ll > _round_best.value:
+                    _round_best.value = ll
+        #log-likelihoods are negative, so the round's best times prune_factor is a lower score
+        if monitor['evals'] >= prune_after and monitor['ll'] is not None and monitor['ll'] < prune_factor * _round_best.value:
+            raise PruneReplicate()
+        return sim_model
+    return pruned_func_exec
+
+def make_traced_func(func_exec, fs, trace_rows, grid_times):
+    #--------------------------------------------------------------------------------------
+    # wrap an extrapolating function so every model evaluation asked for by the optimizer is recorded,
+    # appending [evaluation number, log-likelihood, params, seconds, seconds since the start of the
+    # replicate, seconds at each grid size] to trace_rows, see trace_array
+    
+    # Arguments
+    # func_exec: the extrapolating function used by the optimizer, made by make_cached_extrap_func with grid_times
+    # fs: spectrum object name
+    # trace_rows: the list the evaluations are appended to
+    # grid_times: the list func_exec appends the seconds taken at each grid size to, empty when the spectrum was cached
+    #--------------------------------------------------------------------------------------
+    tb_trace = time.time()
+    def traced_func_exec(params, ns, pts):
+        del grid_times[:]
+        tb_eval = time.time()
+        sim_model = func_exec(params, ns, pts)
+        te_eval = time.time()
+        ll = dadi.Inference.ll_multinom(sim_model, fs)
+        trace_rows.append([len(trace_rows)+1, ll, numpy.array(params, dtype=float), te_eval - tb_eval, te_eval - tb_trace, list(grid_times)])
+        return sim_model
+    return traced_func_exec
+
+def trace_array(trace_rows, param_number, grid_number):
+    #--------------------------------------------------------------------------------------
+    # convert the evaluations recorded by make_traced_func to a numpy structured array with the fields
+    # evaluation, ll, params (one column per parameter), seconds, elapsed, grid_seconds (one column per
+    # grid size, all 0 when the spectrum was found in the cache) and cached
+    
+    # Arguments
+    # trace_rows: the list filled by make_traced_func
+    # param_number: number of parameters in the model
+    # grid_number: number of grid sizes in pts
+    #--------------------------------------------------------------------------------------
+    trace = numpy.zeros(len(trace_rows), dtype=[('evaluation', 'i4'), ('ll', 'f8'), ('params', 'f8', (param_number,)), ('seconds', 'f8'),
+                                                ('elapsed', 'f8'), ('grid_seconds', 'f8', (grid_number,)), ('cached', 'b1')])
+    for i, row in enumerate(trace_rows):
+        trace['evaluation'][i], trace['ll'][i], trace['params'][i], trace['seconds'][i], trace['elapsed'][i] = row[:5]
+        if row[5]:
+            trace['grid_seconds'][i] = row[5]
+        else:
+            trace['cached'][i] = True
+    return trace
+
+def write_trace(tracedir, roundrep, trace):
+    #--------------------------------------------------------------------------------------
+    # save the trace of one replicate to a .npy file named by the replicate (ex, "Round_1_Replicate_10.npy")
+    # in tracedir, so each trace is written once and doesn't need to be kept in memory afterwards
+    
+    # Arguments
+    # tracedir: the folder holding the traces of a model
+    # roundrep: name of replicate (ex, "Round_1_Replicate_10")
+    # trace: the array made by trace_array
+    #--------------------------------------------------------------------------------------
+    if not os.path.isdir(tracedir):
+        os.makedirs(tracedir)
+    tracename = os.path.join(tracedir, "{}.npy".format(roundrep))
+    tempname = "{}.tmp".format(tracename)
+    fh_trace = open(tempname, 'wb')
+    numpy.save(fh_trace, trace)
+    fh_trace.close()
+    os.rename(tempname, tracename)
+
+def read_traces(tracedir):
+    #--------------------------------------------------------------------------------------
+    # return an ordered dictionary of the traces saved by write_trace, keyed on replicate name in round and
+    # replicate order, with each array memory-mapped so only the parts that are used are read from disk
+    
+    # Arguments
+    # tracedir: the folder holding the traces of a model, ex. "outfile.model_name.trace"
+    #--------------------------------------------------------------------------------------
+    roundreps = [x[:-len(".npy")] for x in os.listdir(tracedir) if x.startswith("Round_") and x.endswith(".npy")]
+    roundreps.sort(key=lambda x: [int(y) for y in x.split("_")[1::2]])
+    traces = collections.OrderedDict()
+    for roundrep in roundreps:
+        traces[roundrep] = numpy.load(os.path.join(tracedir, "{}.npy".format(roundrep)), mmap_mode='r')
+    return traces
+
+def add_timing(timings, category, seconds, calls=1):
+    #--------------------------------------------------------------------------------------
+    # add to the time spent on a category of work, where timings is a dictionary of category: [seconds, calls],
+    # nothing is done if timings is None so timing can be left off without checking at every step
+    
+    # Arguments
+    # timings: the dictionary, or None
+    # category: name of the work, ex. "theta"
+    # seconds: time taken
+    # calls: number of times the work was done in that time
+    #--------------------------------------------------------------------------------------
+    if timings is None:
+        return
+    entry = timings.setdefault(category, [0.0, 0])
+    entry[0] += seconds
+    entry[1] += calls
+
+def merge_timings(total, timings):
+    #--------------------------------------------------------------------------------------
+    # add all the categories of one timings dictionary (see add_timing) to another
+    
+    # Arguments
+    # total: the dictionary added to
+    # timings: the dictionary added
+    #--------------------------------------------------------------------------------------
+    for category, (seconds, calls) in timings.items():
+        add_timing(total, category, seconds, calls)
+
+def make_profiled_func(func_exec, grid_times, timings):
+    #--------------------------------------------------------------------------------------
+    # wrap an extrapolating function so the time taken by every model evaluation is added to timings (see add_timing),
+    # split into the model at each grid size ("grid_50", "grid_60", ...) and the extrapolation, or "cached_evaluation"
+    # when the spectrum was found in the cache
+    
+    # Arguments
+    # func_exec: the extrapolating function, made by make_cached_extrap_func with grid_times
+    # grid_times: the list func_exec appends the seconds taken at each grid size to
+    # timings: the dictionary the times are added to
+    #--------------------------------------------------------------------------------------
+    def profiled_func_exec(params, ns, pts):
+        del grid_times[:]
+        tb_eval = time.time()
+        sim_model = func_exec(params, ns, pts)
+        te_eval = time.time() - tb_eval
+        if grid_times:
+            for pt, seconds in zip(numpy.atleast_1d(pts), grid_times):
+                add_timing(timings, "grid_{}".format(pt), seconds)
+            add_timing(timings, "extrapolation", te_eval - sum(grid_times))
+        else:
+            add_timing(timings, "cached_evaluation", te_eval)
+        return sim_model
+    return profiled_func_exec
+
+def make_shared_ll(ll_func, timings):
+    #--------------------------------------------------------------------------------------
+    # wrap a log-likelihood function (ex. dadi.Inference.ll_multinom) so the log-likelihood of a model evaluation
+    # is calculated once and shared by make_traced_func, make_pruned_func and the optimizer's objective, which
+    # all ask for it with the same model spectrum object: the last model, data and log-likelihood are kept, and
+    # a call with the same two objects returns the kept value; the time taken by every calculation (not the calls
+    # answered from the kept value) is added to the "ll_multinom" category of timings (see add_timing)
+    
+    # Arguments
+    # ll_func: the log-likelihood function
+    # timings: the dictionary the times are added to, or None
+    #--------------------------------------------------------------------------------------
+    last = [None, None, None]
+    def shared_ll(model, data):
+        if model is last[0] and data is last[1]:
+            return last[2]
+        tb_ll = time.time()
+        ll = ll_func(model, data)
+        add_timing(timings, "ll_multinom", time.time() - tb_ll)
+        last[:] = [model, data, ll]
+        return ll
+    return shared_ll
+
+def evaluation_seconds(timings):
+    #--------------------------------------------------------------------------------------
+    # return the total time recorded by make_profiled_func and make_shared_ll in a timings dictionary,
+    # the time spent evaluating the model and its log-likelihood
+    
+    # Arguments
+    # timings: the dictionary, see add_timing
+    #--------------------------------------------------------------------------------------
+    return sum(seconds for category, (seconds, calls) in timings.items() if category.startswith("grid_") or category in ("extrapolation", "cached_evaluation", "ll_multinom"))
+
+def read_timings(timingname):
+    #--------------------------------------------------------------------------------------
+    # return the timings of each round saved by write_timings, as an ordered dictionary of
+    # round number: {'replicates':..., 'seconds':..., 'categories':timings dictionary}, empty if there is no file
+    
+    # Arguments
+    # timingname: the .json file
+    #--------------------------------------------------------------------------------------
+    timing_rounds = collections.OrderedDict()
+    if os.path.exists(timingname):
+        fh_timing = open(timingname, 'r')
+        saved = json.load(fh_timing)
+        fh_timing.close()
+        for saved_round in saved['rounds']:
+            timing_rounds[saved_round['round']] = {'replicates':saved_round['replicates'], 'seconds':saved_round['seconds'],
+                                                  'categories':dict((x, [y['seconds'], y['calls']]) for x, y in saved_round['categories'].items())}
+    return timing_rounds
+
+def write_timings(timingname, model_name, pts, timing_rounds):
+    #--------------------------------------------------------------------------------------
+    # save the time spent on each category of work in each round, and over all rounds, to a .json file
+    
+    # Arguments
+    # timingname: the .json file
+    # model_name, pts: as passed to Optimize_Routine
+    # timing_rounds: ordered dictionary of round number: {'replicates':number of replicates run, 'seconds':wall clock
+    #                time of the round, 'categories':timings dictionary, see add_timing}
+    #--------------------------------------------------------------------------------------
+    def categories_json(timings):
+        return collections.OrderedDict((x, {'seconds':timings[x][0], 'calls':timings[x][1]}) for x in sorted(timings, key=lambda x: -timings[x][0]))
+    total = {}
+    saved_rounds = []
+    for round_num, timing_round in timing_rounds.items():
+        merge_timings(total, timing_round['categories'])
+        saved_rounds.append(collections.OrderedDict([('round', round_num), ('replicates', timing_round['replicates']),
+                                                     ('seconds', timing_round['seconds']), ('categories', categories_json(timing_round['categories']))]))
+    saved = collections.OrderedDict([('model_name', model_name), ('pts', [int(x) for x in numpy.atleast_1d(pts)]),
+                                     ('replicates', sum(x['replicates'] for x in timing_rounds.values())),
+                                     ('seconds', sum(x['seconds'] for x in timing_rounds.values())),
+                                     ('categories', categories_json(total)), ('rounds', saved_rounds)])
+    tempname = "{}.tmp".format(timingname)
+    fh_timing = open(tempname, 'w')
+    json.dump(saved, fh_timing, indent=2)
+    fh_timing.close()
+    os.rename(tempname, timingname)
+
 def parse_params(param_number, in_params=None, in_upper=None, in_lower=None):
     #--------------------------------------------------------------------------------------
     # function to correctly deal with parameters and bounds, if none were provided, generate them automatically
@@ -88,7 +604,103 @@ def parse_opt_settings(rounds, reps=None, maxiters=None, folds=None):
     #send back values
     return reps_list, maxiters_list, folds_list
 
-def collect_results(fs, sim_model, params_opt, roundrep):
+def scale_pts(pts, ns, proj):
+    #--------------------------------------------------------------------------------------
+    # return grid sizes for a spectrum projected down to smaller sample sizes, scaling pts in proportion to
+    # the largest sample size while keeping every grid larger than that sample size and the grids increasing
+    
+    # Arguments
+    # pts: grid sizes used for the full spectrum
+    # ns: sample sizes of the full spectrum
+    # proj: sample sizes of the projected spectrum
+    #--------------------------------------------------------------------------------------
+    ratio = float(max(proj)) / max(ns)
+    scaled = []
+    for pt in pts:
+        pt = max(int(round(pt * ratio)), int(max(proj)) + 2)
+        if scaled and pt <= scaled[-1]:
+            pt = scaled[-1] + 2
+        scaled.append(pt)
+    return scaled
+
+def design_starts(n, lower_bound, upper_bound, design, seed):
+    #--------------------------------------------------------------------------------------
+    # return n starting parameter sets spread evenly between the bounds, from a latin hypercube ("lhs") or a randomly
+    # shifted halton sequence ("halton"); parameters with a lower bound above zero are spread evenly in log space
+
+    # Arguments
+    # n: number of starting parameter sets
+    # lower_bound: a list of lower bound values
+    # upper_bound: a list of upper bound values
+    # design: "lhs" or "halton"
+    # seed: seed for the random part of the design, so the same starts can be drawn again
+    #--------------------------------------------------------------------------------------
+    n = int(n)
+    lower = numpy.array(lower_bound, dtype=float)
+    upper = numpy.array(upper_bound, dtype=float)
+    dims = len(lower)
+    rng = numpy.random.RandomState(seed)
+    if design == "lhs":
+        #one value in each of n equal slices of every parameter, with the slices paired up at random
+        unit = numpy.empty((n, dims))
+        for d in range(dims):
+            unit[:,d] = (rng.permutation(n) + rng.uniform(size=n)) / n
+    elif design == "halton":
+        #the first primes are the bases of the halton sequence, one for each parameter
+        bases = []
+        candidate = 2
+        while len(bases) < dims:
+            if all(candidate % x for x in bases):
+                bases.append(candidate)
+            candidate += 1
+        unit = numpy.zeros((n, dims))
+        for d, base in enumerate(bases):
+            for i in range(n):
+                k = i + 1
+                f = 1.0
+                while k > 0:
+                    f /= base
+                    unit[i,d] += f * (k % base)
+                    k //= base
+        #shifting the whole sequence by the same random amount keeps its spacing but gives each seed other starts
+        unit = (unit + rng.uniform(size=dims)) % 1.0
+    else:
+        raise ValueError("Unknown start design '{}', use 'lhs' or 'halton'".format(design))
+    logged = lower > 0
+    low = numpy.where(logged, numpy.log(numpy.where(logged, lower, 1)), lower)
+    high = numpy.where(logged, numpy.log(numpy.where(logged, upper, 1)), upper)
+    values = low + unit * (high - low)
+    values[:,logged] = numpy.exp(values[:,logged])
+    return [list(x) for x in values]
+
+def distinct_optima(results, k, min_distance, lower_bound):
+    #--------------------------------------------------------------------------------------
+    # return up to k of the best replicates that are at least min_distance apart, skipping any that
+    # are too close to a better one already chosen; the distance is the root mean square difference of the parameters,
+    # in log space for parameters with a lower bound above zero
+
+    # Arguments
+    # results: list of replicate results made by collect_results, sorted best first
+    # k: largest number of parameter sets to return, at least 1
+    # min_distance: smallest distance between two parameter sets for both to be returned, at least 0
+    # lower_bound: a list of lower bound values
+    #--------------------------------------------------------------------------------------
+    if int(k) < 1 or min_distance < 0:
+        raise ValueError("distinct_optima needs k of at least 1 and a min_distance of at least 0: {0}, {1}".format(k, min_distance))
+    logged = numpy.array(lower_bound, dtype=float) > 0
+    chosen = []
+    scaled = []
+    for rep_results in results:
+        values = numpy.array(rep_results[5], dtype=float)
+        values[logged] = numpy.log(values[logged])
+        if all(numpy.sqrt(numpy.mean((values - x)**2)) >= min_distance for x in scaled):
+            chosen.append(rep_results)
+            scaled.append(values)
+            if len(chosen) == int(k):
+                break
+    return chosen
+
+def collect_results(fs, sim_model, params_opt, roundrep, timings=None):
     #--------------------------------------------------------------------------------------
     # gather up a bunch of results, return a list = [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values] 
     
@@ -96,13 +708,16 @@ def collect_results(fs, sim_model, params_opt, roundrep):
     # fs: spectrum object name
     # sim_model: model fit with optimized parameters
     # params_opt: list of the optimized parameters
+    # timings: if given, a dictionary the time taken by each step is added to, see add_timing
     #--------------------------------------------------------------------------------------
 
     #create empty list to store results
     temp_results = []
 
     #calculate likelihood
+    tb_step = time.time()
     ll = dadi.Inference.ll_multinom(sim_model, fs)
+    add_timing(timings, "ll_multinom", time.time() - tb_step)
     ll = numpy.around(ll, 2)
     print "\t\t\tLikelihood = ", ll
 
@@ -111,14 +726,20 @@ def collect_results(fs, sim_model, params_opt, roundrep):
     print "\t\t\tAIC = ", aic
 
     #calculate theta
+    tb_step = time.time()
     theta = dadi.Inference.optimal_sfs_scaling(sim_model, fs)
+    add_timing(timings, "theta", time.time() - tb_step)
     theta = numpy.around(theta, 2)
     print "\t\t\tTheta = ", theta
 
     #calculate Chi^2 statistic
+    tb_step = time.time()
     scaled_sim_model = sim_model*theta
     folded_sim_model = scaled_sim_model.fold()
+    add_timing(timings, "fold", time.time() - tb_step)
+    tb_step = time.time()
     chi2 = numpy.sum((folded_sim_model - fs)**2/folded_sim_model)
+    add_timing(timings, "chi2", time.time() - tb_step)
     chi2 = numpy.around(chi2, 2)
     print "\t\t\tChi-Squared = ", chi2
 
@@ -133,32 +754,372 @@ def collect_results(fs, sim_model, params_opt, roundrep):
     #send list of results back
     return temp_results
 
-def write_log(outfile, model_name, rep_results, roundrep):
+def write_log(outfile, model_name, rep_results, roundrep, optlog="", seed=None):
     #--------------------------------------------------------------------------------------
-    #reproduce replicate log to bigger log file, because constantly re-written
+    #add the log of a replicate to the bigger log file, in a single write so runs sharing the file don't interleave
     
     # Arguments =
     # outfile: prefix for output naming
     # model_name: a label to slap on the output files; ex. "no_mig"
     # rep_results: the list returned by collect_results function: [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
     # roundrep: name of replicate (ex, "Round_1_Replicate_10")
+    # optlog: the steps of the optimizer for this replicate, as caught by optimize_in_memory
+    # seed: the seed used to perturb the starting parameters of this replicate, written to the log if given
     #--------------------------------------------------------------------------------------
-    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
-    fh_log.write("\n{}\n".format(roundrep))
-    templogname = "{}.log.txt".format(model_name)
-    try:
-        fh_templog = open(templogname, 'r')
-        for line in fh_templog:
-            fh_log.write(line)
-        fh_templog.close()
-    except IOError:
+    log_lines = ["\n{}\n".format(roundrep)]
+    if seed is not None:
+        log_lines.append("seed = {}\n".format(seed))
+    if not optlog:
         print "Nothing written to log file this replicate..."
-    fh_log.write("likelihood = {}\n".format(rep_results[1]))
-    fh_log.write("theta = {}\n".format(rep_results[4]))
-    fh_log.write("Optimized parameters = {}\n".format(rep_results[5]))
+    log_lines.append(optlog)
+    log_lines.append("likelihood = {}\n".format(rep_results[1]))
+    log_lines.append("theta = {}\n".format(rep_results[4]))
+    log_lines.append("Optimized parameters = {}\n".format(rep_results[5]))
+    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
+    fh_log.write("".join(log_lines))
     fh_log.close()
 
-def Optimize_Routine(fs, pts, outfile, model_name, func, rounds, param_number, reps=None, maxiters=None, folds=None, in_params=None, in_upper=None, in_lower=None, param_labels=" "):
+def optimize_in_memory(trace, params_perturbed, fs, func_exec, pts, lower_bound, upper_bound, maxiter):
+    #--------------------------------------------------------------------------------------
+    # run dadi.Inference.optimize_log_fmin and return the optimized parameters, with the step by step
+    # output of the optimizer written to trace rather than to a log file on disk; given no output file
+    # the optimizer writes to sys.stdout, so that is swapped for trace while it runs
+    
+    # Arguments
+    # trace: a file-like object kept in memory, ex. cStringIO.StringIO(), still holding the steps taken if the optimizer raises
+    # params_perturbed: the starting parameters
+    # fs, func_exec, pts, lower_bound, upper_bound, maxiter: as passed to optimize_log_fmin
+    #--------------------------------------------------------------------------------------
+    stdout = sys.stdout
+    sys.stdout = trace
+    try:
+        return dadi.Inference.optimize_log_fmin(params_perturbed, fs, func_exec, pts, lower_bound=lower_bound, upper_bound=upper_bound, verbose=1, maxiter=maxiter, output_file=None)
+    finally:
+        sys.stdout = stdout
+
+def derive_seed(seed, *keys):
+    #--------------------------------------------------------------------------------------
+    # combine a seed with labels (ex. a round and replicate number) into a new, independent seed for numpy.random.seed
+    
+    # Arguments
+    # seed: the seed everything else is derived from
+    # keys: any number of labels identifying the stream, ex. 2, 5 for replicate 5 of round 2
+    #--------------------------------------------------------------------------------------
+    return int(hashlib.md5(",".join(str(x) for x in (seed,) + keys)).hexdigest()[:8], 16)
+
+def replicate_label(roundrep, pruned):
+    #--------------------------------------------------------------------------------------
+    # return the name a replicate is written under in the optimized.txt files, with "_pruned" added
+    # (ex, "Round_1_Replicate_10_pruned") if it was stopped early rather than optimized to the end
+    #--------------------------------------------------------------------------------------
+    if pruned:
+        return "{}_pruned".format(roundrep)
+    return roundrep
+
+def read_results_file(outname):
+    #--------------------------------------------------------------------------------------
+    # read the replicates of the last run written to an optimized.txt file (the rows below the last header line) back into
+    # the list format made by collect_results - [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
+    # returns a dictionary of these lists keyed on the replicate name (ex, "Round_1_Replicate_10")
+    
+    # Arguments
+    # outname: name of the optimized.txt file
+    #--------------------------------------------------------------------------------------
+    done = {}
+    if not os.path.exists(outname):
+        return done
+    fh_in = open(outname, 'r')
+    for line in fh_in:
+        line_items = line.strip().split('\t')
+        #each run starts with a header line, the rows above it belong to earlier runs
+        if line_items[0] == "Model":
+            done = {}
+            continue
+        #skip any row cut short by a job that was killed while writing
+        if len(line_items) != 7 or not line_items[1].startswith("Round_"):
+            continue
+        #replicates that were stopped early are named without their "_pruned" mark
+        roundrep = line_items[1]
+        if roundrep.endswith("_pruned"):
+            roundrep = roundrep[:-len("_pruned")]
+        try:
+            params_opt = numpy.array([float(x) for x in line_items[6].split(',')])
+            done[roundrep] = [roundrep, float(line_items[2]), float(line_items[3]), float(line_items[4]), float(line_items[5]), params_opt]
+        except ValueError:
+            continue
+    fh_in.close()
+    return done
+
+def read_checkpoint(checkpoint_name):
+    #--------------------------------------------------------------------------------------
+    # load the checkpoint written by Optimize_Routine when resume is used, or start a new one
+    # the checkpoint is a dictionary holding:
+    #   seed: the seed the starting parameters of every replicate are derived from
+    #   results: the full precision results of each finished replicate, keyed on replicate name
+    #   prescreen: the starting parameters kept by the prescreen of the first round, once it has been run
+    
+    # Arguments
+    # checkpoint_name: name of the checkpoint file
+    #--------------------------------------------------------------------------------------
+    if os.path.exists(checkpoint_name):
+        fh_cp = open(checkpoint_name, 'rb')
+        checkpoint = cPickle.load(fh_cp)
+        fh_cp.close()
+    else:
+        checkpoint = {'seed':None, 'results':{}}
+    return checkpoint
+
+def write_checkpoint(checkpoint_name, checkpoint):
+    #--------------------------------------------------------------------------------------
+    # write the checkpoint to a temporary file and move it into place, so a job killed
+    # part way through writing never leaves a damaged checkpoint behind
+    
+    # Arguments
+    # checkpoint_name: name of the checkpoint file
+    # checkpoint: the dictionary described in read_checkpoint
+    #--------------------------------------------------------------------------------------
+    tempname = "{}.tmp".format(checkpoint_name)
+    fh_cp = open(tempname, 'wb')
+    cPickle.dump(checkpoint, fh_cp, 2)
+    fh_cp.close()
+    os.rename(tempname, checkpoint_name)
+
+def open_results_db(results_db):
+    #--------------------------------------------------------------------------------------
+    # open the SQLite results store, creating the table of replicates the first time, and return the connection
+    # there is one row per replicate, identified by the outfile prefix, model name, seed of the run and replicate name,
+    # and pruned is 1 for replicates that were stopped early
+    
+    # Arguments
+    # results_db: path to the SQLite file
+    #--------------------------------------------------------------------------------------
+    conn = sqlite3.connect(results_db, timeout=600)
+    conn.execute("CREATE TABLE IF NOT EXISTS replicates (outfile TEXT, model_name TEXT, run_seed INTEGER, replicate TEXT, "
+                 "round INTEGER, rep INTEGER, ll REAL, aic REAL, chi2 REAL, theta REAL, params TEXT, param_labels TEXT, "
+                 "seconds REAL, seed INTEGER, pts TEXT, sample_sizes TEXT, finished TEXT, pruned INTEGER DEFAULT 0, "
+                 "PRIMARY KEY (outfile, model_name, run_seed, replicate))")
+    #files made before replicates stopped early were marked get the column added
+    if "pruned" not in [x[1] for x in conn.execute("PRAGMA table_info(replicates)")]:
+        conn.execute("ALTER TABLE replicates ADD COLUMN pruned INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS replicates_model_aic ON replicates (model_name, aic)")
+    conn.commit()
+    return conn
+
+def write_results_db(conn, outfile, model_name, run_seed, rep_results, rep_info, seed, param_labels, pts, fs):
+    #--------------------------------------------------------------------------------------
+    # add a finished replicate to the results store, the parameters are kept at full precision
+    # as comma separated values, a replicate that is run again (ex. after resuming) replaces its row
+    
+    # Arguments
+    # conn: connection returned by open_results_db
+    # outfile, model_name, param_labels, pts, fs: as passed to Optimize_Routine
+    # run_seed: the seed of the whole run
+    # rep_results, rep_info: the lists returned by run_replicate
+    # seed: the seed the starting parameters of the replicate were perturbed with
+    #--------------------------------------------------------------------------------------
+    round_num, rep = [int(x) for x in rep_results[0].split("_")[1::2]]
+    conn.execute("INSERT OR REPLACE INTO replicates VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                 (outfile, model_name, run_seed, rep_results[0], round_num, rep, float(rep_results[1]), float(rep_results[2]),
+                  float(rep_results[3]), float(rep_results[4]), ",".join(repr(float(x)) for x in rep_results[5]), param_labels,
+                  rep_info['seconds'], seed, ",".join(str(x) for x in pts), ",".join(str(x) for x in fs.sample_sizes),
+                  datetime.now().isoformat(), int(rep_info['pruned'])))
+    conn.commit()
+
+def Export_Results(results_db, outfile=None, model_name=None, out_prefix=None):
+    #--------------------------------------------------------------------------------------
+    # write the replicates kept in a results store to tab-delimited files in the same format as the
+    # optimized.txt files written by Optimize_Routine, one file per outfile prefix and model, with each
+    # run starting a new section with its own header as when a run is appended to an existing file;
+    # replicates of exploratory rounds (those not run on the grid and sample sizes of the last round of their run)
+    # go to exploratory.txt files instead, and replicates that were stopped early are marked as in the optimized.txt files
+    # (see replicate_label), returns the list of files written
+    
+    # Mandatory Arguments =
+    #(1) results_db: path to the SQLite file given to Optimize_Routine or Optimize_Model_Set
+
+    # Optional Arguments =
+    #(2) outfile: only export the replicates run with this outfile prefix (default None exports all of them)
+    #(3) model_name: only export the replicates of this model (default None exports all of them)
+    #(4) out_prefix: prefix used to name the exported files in place of the outfile prefix of the run, ex. to avoid
+    #     replacing the optimized.txt files the runs wrote (default None)
+    #--------------------------------------------------------------------------------------
+    #opened the same way as by Optimize_Routine, so files made before the pruned column was added get it too
+    conn = open_results_db(results_db)
+    where = []
+    values = []
+    if outfile is not None:
+        where.append("outfile = ?")
+        values.append(outfile)
+    if model_name is not None:
+        where.append("model_name = ?")
+        values.append(model_name)
+    if where:
+        where = " WHERE " + " AND ".join(where)
+    else:
+        where = ""
+    rows = conn.execute("SELECT outfile, model_name, run_seed, replicate, ll, aic, chi2, theta, params, param_labels, "
+                        "round, rep, rowid, pts, sample_sizes, pruned FROM replicates" + where, values).fetchall()
+    conn.close()
+
+    #runs are written in the order they were started, and their replicates in round and replicate order,
+    #and the grid and sample sizes of the last round of each run are the ones the replicates are not exploratory on
+    run_order = {}
+    run_fidelity = {}
+    for row in rows:
+        run_order[row[:3]] = min(run_order.get(row[:3], row[12]), row[12])
+        run_fidelity[row[:3]] = max(run_fidelity.get(row[:3], (row[10], row[13:15])), (row[10], row[13:15]))
+    rows.sort(key=lambda x: (x[0], x[1], run_order[x[:3]], x[10], x[11]))
+
+    #gather the lines of each file, then write them
+    out_lines = collections.OrderedDict()
+    last_run = {}
+    for row in rows:
+        if out_prefix is None:
+            prefix = row[0]
+        else:
+            prefix = out_prefix
+        if row[13:15] == run_fidelity[row[:3]][1]:
+            outname = "{0}.{1}.optimized.txt".format(prefix, row[1])
+        else:
+            outname = "{0}.{1}.exploratory.txt".format(prefix, row[1])
+        lines = out_lines.setdefault(outname, [])
+        if last_run.get(outname) != row[2]:
+            lines.append("Model"+'\t'+"Replicate"+'\t'+"log-likelihood"+'\t'+"AIC"+'\t'+"chi-squared"+'\t'+"theta"+'\t'+"optimized_params({})".format(row[9])+'\n')
+            last_run[outname] = row[2]
+        #join the param values together with commas
+        easy_p = ",".join(str(numpy.around(float(x), 4)) for x in row[8].split(","))
+        lines.append("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(row[1], replicate_label(row[3], row[15]), numpy.float64(row[4]), row[5], numpy.float64(row[6]), numpy.float64(row[7]), easy_p))
+    for outname, lines in out_lines.items():
+        tempname = "{}.tmp".format(outname)
+        fh_out = open(tempname, 'w')
+        fh_out.write("".join(lines))
+        fh_out.close()
+        os.rename(tempname, outname)
+    return out_lines.keys()
+
+def screen_candidates(job):
+    #--------------------------------------------------------------------------------------
+    # evaluate the model once for each of a list of candidate starting parameters and return their log-likelihoods,
+    # with -inf for any that could not be evaluated; the unit of work handed to a pool when pre-screening starts
+
+    # Arguments
+    # job: dictionary with the keys below, built by Optimize_Routine
+    #   fs, pts, func: as passed to Optimize_Routine
+    #   candidates: a list of parameter sets
+    #--------------------------------------------------------------------------------------
+    func_exec = dadi.Numerics.make_extrap_log_func(job['func'])
+    lls = []
+    for params in job['candidates']:
+        try:
+            sim_model = func_exec(params, job['fs'].sample_sizes, job['pts'])
+            ll = float(dadi.Inference.ll_multinom(sim_model, job['fs']))
+        except Exception:
+            ll = float('-inf')
+        if numpy.isnan(ll):
+            ll = float('-inf')
+        lls.append(ll)
+    return lls
+
+def run_replicate(job):
+    #--------------------------------------------------------------------------------------
+    # optimize a single replicate and return [rep_results, rep_info], where rep_results is the list made by
+    # collect_results and rep_info is a dictionary of details about the run (seconds: time taken by the replicate,
+    # log: the steps of the optimizer, to be added to the log file with write_log, trace: the array made by
+    # trace_array, or None if the replicate was not traced, timings: the time spent on each category of work,
+    # see add_timing, or None if the replicate was not timed, pruned: True if the replicate was stopped early)
+    # this is the unit of work handed to the worker pool when Optimize_Routine is given workers,
+    # so everything it needs is passed in through the job dictionary
+    
+    # Arguments
+    # job: dictionary with the keys below, built by Optimize_Routine
+    #   fs, pts, func, lower_bound, upper_bound: as passed to Optimize_Routine
+    #   maxiter: maxiter argument for this round
+    #   params_perturbed: the perturbed starting parameters for this replicate
+    #   roundrep: name of replicate (ex, "Round_1_Replicate_10")
+    #   label: the heading printed for this replicate (ex, "Round 1 Replicate 10 of 20")
+    #   cache_size, cache_dir, cache_dir_mb: the cache arguments for make_cached_extrap_func
+    #   grid_pool: pool used to evaluate the grid sizes at the same time, or None
+    #   seed: the seed the starting parameters were perturbed with, written to the log
+    #   prune_factor, prune_after: the pruning arguments for make_pruned_func, prune_factor is None when not pruning
+    #   trace: if True, record every model evaluation with make_traced_func
+    #   timings: if True, record the time spent on each category of work
+    #--------------------------------------------------------------------------------------
+    print "\t\t{}:".format(job['label'])
+    
+    #keep track of start time for rep
+    tb_rep = datetime.now()
+    hits_before, misses_before, cached = cache_info()
+    
+    #create an extrapolating function, the final step of the optimizer is cached so the simulation below is not repeated
+    #when tracing or timing, the time taken at each grid size is recorded as well
+    if job['trace'] or job['timings']:
+        grid_times = []
+        func_exec = make_cached_extrap_func(job['func'], job['cache_size'], cache_dir=job['cache_dir'], cache_dir_mb=job['cache_dir_mb'], grid_pool=job['grid_pool'], grid_times=grid_times)
+    else:
+        func_exec = make_cached_extrap_func(job['func'], job['cache_size'], cache_dir=job['cache_dir'], cache_dir_mb=job['cache_dir_mb'], grid_pool=job['grid_pool'])
+    if job['timings']:
+        timings = {}
+        func_exec = make_profiled_func(func_exec, grid_times, timings)
+    else:
+        timings = None
+    #when tracing, the optimizer is given a version that records every evaluation
+    if job['trace']:
+        trace_rows = []
+        opt_func_exec = make_traced_func(func_exec, job['fs'], trace_rows, grid_times)
+    else:
+        opt_func_exec = func_exec
+
+    #optimize from perturbed parameters, stopping early if the replicate falls too far behind the round's best
+    #the steps of the optimizer are kept in memory and written to the log file with the results
+    trace = cStringIO.StringIO()
+    tb_opt = time.time()
+    pruned = False
+    #the log-likelihood of every evaluation is needed by the optimizer's objective and by the tracing and pruning
+    #wrappers, so while the optimizer runs the function they look up in dadi.Inference is swapped for one that
+    #calculates it once per evaluation (and times it when timing)
+    share_ll = timings is not None or job['trace'] or job['prune_factor'] is not None
+    if share_ll:
+        ll_multinom = dadi.Inference.ll_multinom
+        dadi.Inference.ll_multinom = make_shared_ll(ll_multinom, timings)
+    try:
+        if job['prune_factor'] is None:
+            params_opt = optimize_in_memory(trace, job['params_perturbed'], job['fs'], opt_func_exec, job['pts'], job['lower_bound'], job['upper_bound'], job['maxiter'])
+        else:
+            monitor = {}
+            pruned_func_exec = make_pruned_func(opt_func_exec, job['fs'], job['prune_factor'], job['prune_after'], monitor)
+            try:
+                params_opt = optimize_in_memory(trace, job['params_perturbed'], job['fs'], pruned_func_exec, job['pts'], job['lower_bound'], job['upper_bound'], job['maxiter'])
+            except PruneReplicate:
+                params_opt = monitor['params']
+                pruned = True
+                trace.write("Stopped early after {0} evaluations, best log-likelihood {1} vs round best {2}\n".format(monitor['evals'], monitor['ll'], _round_best.value))
+                print "\t\t\tStopped early after {} evaluations".format(monitor['evals'])
+    finally:
+        if share_ll:
+            dadi.Inference.ll_multinom = ll_multinom
+    #the optimizer's own work between model evaluations and their log-likelihoods
+    if timings is not None:
+        add_timing(timings, "optimizer", time.time() - tb_opt - evaluation_seconds(timings))
+    print "\t\t\tOptimized parameters = ", params_opt
+
+    #simulate the model with the optimized parameters
+    sim_model = func_exec(params_opt, job['fs'].sample_sizes, job['pts'])
+
+    #collect results into a list using function above - [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
+    rep_results = collect_results(job['fs'], sim_model, params_opt, job['roundrep'], timings)
+
+    #calculate elapsed time for replicate
+    tf_rep = datetime.now()
+    te_rep = tf_rep - tb_rep
+    hits_after, misses_after, cached = cache_info()
+    print "\n\t\t\tReplicate time: {0} (H:M:S), model spectra cached: {1} hits, {2} misses\n".format(te_rep, hits_after-hits_before, misses_after-misses_before)
+    rep_info = {'seconds':te_rep.total_seconds(), 'log':trace.getvalue(), 'trace':None, 'timings':timings, 'pruned':pruned}
+    if job['trace']:
+        rep_info['trace'] = trace_array(trace_rows, len(job['params_perturbed']), len(numpy.atleast_1d(job['pts'])))
+
+    return [rep_results, rep_info]
+
+def Optimize_Routine(fs, pts, outfile, model_name, func, rounds, param_number, reps=None, maxiters=None, folds=None, in_params=None, in_upper=None, in_lower=None, param_labels=" ", workers=None, resume=False, cache_size=10, cache_dir=None, cache_dir_mb=1000, parallel_grids=False, seed=None, prune_factor=None, prune_after=20, converge_k=None, converge_tol=1.0, max_reps=None, results_db=None, trace=False, timings=False, round_pts=None, round_projections=None, start_design=None, prescreen=None, prescreen_keep=None, top_k=None, top_k_distance=0.1):
     #--------------------------------------------------------------------------------------
     # Mandatory Arguments =
     #(1) fs:  spectrum object name
@@ -177,6 +1138,53 @@ def Optimize_Routine(fs, pts, outfile, model_name, func, rounds, param_number, r
     #(12) in_upper: a list of upper bound values
     #(13) in_lower: a list of lower bound values
     #(14) param_labels: list of labels for parameters that will be written to the output file to keep track of their order
+    #(15) workers: number of processes used to run the replicates of each round in parallel (default None runs them one at a time);
+    #     func must then be defined at the top level of a script or module so it can be sent to the worker processes
+    #(16) resume: if True, keep a checkpoint ("outfile.model_name.checkpoint.pkl") while running, and when called again after
+    #     the job was killed, skip the replicates already in the optimized.txt file and carry on where it stopped
+    #(17) cache_size: number of model spectra kept in memory so repeated evaluations are not integrated again (default 10, 0 turns this off)
+    #(18) cache_dir: a directory where model spectra are also saved, so later runs and other scripts can reuse them (default None)
+    #(19) cache_dir_mb: size limit in megabytes for cache_dir, the least recently used spectra are removed past this (default 1000)
+    #(20) parallel_grids: if True, evaluate the model at each of the pts grid sizes at the same time in separate processes,
+    #     useful when there are too few replicates to keep the cores busy (cannot be combined with workers)
+    #(21) seed: integer the starting parameters of every replicate are derived from, so a run can be repeated exactly
+    #     (default None draws one from numpy's random number generator), written to the log file
+    #(22) prune_factor: stop a replicate once its best log-likelihood is this many times worse than the best reached so far
+    #     by any replicate of the round, ex. 2 (default None never stops replicates early); with workers, which replicates
+    #     are stopped depends on the order they finish in, so results are no longer exactly reproducible from the seed
+    #(23) prune_after: number of model evaluations every replicate gets before it can be stopped (default 20)
+    #(24) converge_k: if given, reps is the smallest number of replicates in each round, and replicates are added after
+    #     that until the best converge_k log-likelihoods of the round are within converge_tol of each other (default None uses reps)
+    #(25) converge_tol: largest difference in log-likelihood between the best converge_k replicates of a round for it to end (default 1.0)
+    #(26) max_reps: a list of integers, the largest number of replicates in each round when converge_k is used (default twice reps)
+    #(27) results_db: path to an SQLite file that every replicate is also added to, with full precision parameters, the time it
+    #     took and its seed (default None); many runs can share one file, see Export_Results to write it out as text again
+    #(28) trace: if True, record the log-likelihood, parameters and timings of every model evaluation of every replicate,
+    #     saved as numpy structured arrays (see trace_array), one .npy file per replicate in the folder
+    #     "outfile.model_name.trace", which read_traces loads back (default False)
+    #(29) timings: if True, record the time spent perturbing parameters, evaluating the model at each grid size, extrapolating,
+    #     in the optimizer, calculating the log-likelihood, theta, folding, chi-squared and writing files, for each round
+    #     and over all rounds, saved to "outfile.model_name.timings.json" (default False)
+    #(30) round_pts: a list with the grid sizes to use in each round, ex. [[20,30,40],[40,50,60],[50,60,70]], where None for a
+    #     round uses pts (default None uses pts in every round); rounds on grids other than pts are exploratory, their replicates
+    #     are written to "outfile.model_name.exploratory.txt" rather than the optimized.txt file, and each round starts from the
+    #     best replicate on the grids of the round before it
+    #(31) round_projections: a list with the sample sizes to project fs down to in each round, ex. [[8,16],[12,24],None], where
+    #     None for a round uses fs as it is (default None uses fs in every round); rounds on a projected spectrum are exploratory
+    #     as above, and unless given grid sizes in round_pts they use pts scaled down in proportion to the largest sample size
+    #(32) start_design: "lhs" or "halton" to spread the starting parameters of the first round evenly between the bounds
+    #     (in log space), from a latin hypercube or halton sequence drawn for the whole round, instead of perturbing in_params
+    #     (default None perturbs in_params)
+    #(33) prescreen: number of candidate starting parameters to evaluate the model at once each before the first round, on
+    #     workers or the parallel_grids processes if given, drawn from start_design or by perturbing in_params (default None)
+    #(34) prescreen_keep: number of the best scoring candidates the first round starts from, between 1 and prescreen, with
+    #     replicates beyond that perturbing them in turn (default None keeps one for every replicate of the first round, or
+    #     all of the candidates if there are fewer)
+    #(35) top_k: if given, the replicates of each round after the first take turns perturbing the parameters of the best
+    #     top_k distinct replicates so far (see distinct_optima), rather than all perturbing the single best
+    #     (default None)
+    #(36) top_k_distance: smallest root mean square difference between the (log) parameters of two replicates for both to
+    #     be used with top_k, closer ones count as the same optimum (default 0.1)
     #--------------------------------------------------------------------------------------
 
     #call function that determines if our params and bounds have been set or need to be generated for us
@@ -184,6 +1192,73 @@ def Optimize_Routine(fs, pts, outfile, model_name, func, rounds, param_number, r
 
     #call function that determines if our replicates, maxiter, and fold have been set or need to be generated for us
     reps_list, maxiters_list, folds_list = parse_opt_settings(rounds, reps, maxiters, folds)
+
+    #in adaptive mode each round runs at least reps replicates and can add more up to max_reps
+    if converge_k is not None:
+        converge_k = int(converge_k)
+        if max_reps is None:
+            max_reps_list = [2 * x for x in reps_list]
+        elif len(max_reps) != int(rounds):
+            raise ValueError("List length of max_reps values does match the number of rounds: {}".format(rounds))
+        elif any(int(x) < y for x, y in zip(max_reps, reps_list)):
+            raise ValueError("max_reps must be at least reps in every round: {0} and {1}".format(max_reps, reps_list))
+        else:
+            max_reps_list = [int(x) for x in max_reps]
+
+    #the spectrum and grid sizes used in each round, the rounds not using both fs and pts are only exploratory
+    if round_projections is None:
+        round_projections = [None] * int(rounds)
+    elif len(round_projections) != int(rounds):
+        raise ValueError("List length of round_projections values does match the number of rounds: {}".format(rounds))
+    if round_pts is None:
+        round_pts = [None] * int(rounds)
+    elif len(round_pts) != int(rounds):
+        raise ValueError("List length of round_pts values does match the number of rounds: {}".format(rounds))
+    round_fs_list = []
+    round_pts_list = []
+    projected = {}
+    for proj, r_pts in zip(round_projections, round_pts):
+        if proj is None or list(proj) == list(fs.sample_sizes):
+            round_fs_list.append(fs)
+        else:
+            proj = tuple(int(x) for x in proj)
+            if proj not in projected:
+                projected[proj] = fs.project(proj)
+            round_fs_list.append(projected[proj])
+        if r_pts is not None:
+            round_pts_list.append(list(r_pts))
+        elif round_fs_list[-1] is fs:
+            round_pts_list.append(list(pts))
+        else:
+            round_pts_list.append(scale_pts(pts, fs.sample_sizes, round_fs_list[-1].sample_sizes))
+    full_fidelity = (list(pts), list(fs.sample_sizes))
+    round_fidelity = [(x, list(y.sample_sizes)) for x, y in zip(round_pts_list, round_fs_list)]
+    def replicate_fidelity(roundrep):
+        return round_fidelity[int(roundrep.split("_")[1]) - 1]
+
+    #worker processes are not allowed to start pools of their own
+    if parallel_grids and workers is not None:
+        raise ValueError("The parallel_grids and workers arguments cannot be used together.")
+
+    #the pre-screen needs at least one candidate, and can't keep more candidates than it evaluates
+    if prescreen is not None:
+        prescreen = int(prescreen)
+        if prescreen < 1:
+            raise ValueError("The number of candidates to pre-screen must be at least 1: {}".format(prescreen))
+        if prescreen_keep is not None:
+            prescreen_keep = int(prescreen_keep)
+            if prescreen_keep < 1 or prescreen_keep > prescreen:
+                raise ValueError("The number of pre-screened candidates to keep must be between 1 and prescreen ({0}): {1}".format(prescreen, prescreen_keep))
+    elif prescreen_keep is not None:
+        raise ValueError("The prescreen_keep argument can only be used with prescreen.")
+
+    #seeding from the best distinct replicates needs at least one of them, at a distance that can't be negative
+    if top_k is not None:
+        top_k = int(top_k)
+        if top_k < 1:
+            raise ValueError("The number of distinct replicates to start from (top_k) must be at least 1: {}".format(top_k))
+        if top_k_distance < 0:
+            raise ValueError("The distance between distinct replicates (top_k_distance) can't be negative: {}".format(top_k_distance))
     
     print "\n\n============================================================================\nModel {}\n============================================================================".format(model_name)
 
@@ -192,76 +1267,983 @@ def Optimize_Routine(fs, pts, outfile, model_name, func, rounds, param_number, r
     
     # We need an output file that will store all summary info for each replicate, across rounds
     outname = "{0}.{1}.optimized.txt".format(outfile,model_name)
-    fh_out = open(outname, 'a')
-    fh_out.write("Model"+'\t'+"Replicate"+'\t'+"log-likelihood"+'\t'+"AIC"+'\t'+"chi-squared"+'\t'+"theta"+'\t'+"optimized_params({})".format(param_labels)+'\n')
-    fh_out.close()
+    #and another for the replicates of exploratory rounds, if there are any
+    explorename = "{0}.{1}.exploratory.txt".format(outfile,model_name)
+
+    #if resuming, find the replicates that were already finished, preferring the full precision values from the checkpoint
+    #only a run that left its checkpoint behind is resumed, the checkpoint is removed once a run finishes, so the rows of
+    #an earlier finished run with the same prefix are not taken for replicates of this one
+    checkpoint_name = "{0}.{1}.checkpoint.pkl".format(outfile,model_name)
+    resuming = resume and os.path.exists(checkpoint_name)
+    if resume:
+        checkpoint = read_checkpoint(checkpoint_name)
+    if resuming:
+        done = read_results_file(outname)
+        done.update(read_results_file(explorename))
+        done.update(checkpoint['results'])
+        print "\tResuming from {0}, {1} replicates already finished\n".format(checkpoint_name, len(done))
+    else:
+        done = {}
+
+    #every replicate gets its own random number stream derived from this seed, a resumed run keeps the seed it started with
+    if resume and checkpoint['seed'] is not None:
+        seed = checkpoint['seed']
+    elif seed is None:
+        seed = numpy.random.randint(0, 2**31 - 1)
+    seed = int(seed)
+    print "\tSeed = {}\n".format(seed)
+    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
+    fh_log.write("\nSeed = {}\n".format(seed))
+    fh_log.close()
+
+    #open the results store if replicates are to be added to one
+    if results_db is None:
+        conn = None
+    else:
+        conn = open_results_db(results_db)
+
+    #the traces of the replicates are saved to a folder as they finish, those of an earlier run with the same names are
+    #cleared out unless it is being resumed
+    tracedir = "{0}.{1}.trace".format(outfile, model_name)
+    if trace and not resuming and os.path.isdir(tracedir):
+        for name in os.listdir(tracedir):
+            if name.startswith("Round_") and name.endswith(".npy"):
+                os.remove(os.path.join(tracedir, name))
+
+    #the time spent on each category of work in each round, keeping that of a run being resumed
+    timingname = "{0}.{1}.timings.json".format(outfile, model_name)
+    if timings and resuming:
+        timing_rounds = read_timings(timingname)
+    else:
+        timing_rounds = collections.OrderedDict()
+
+    #only start a new file (or a new section of an existing file) if there is nothing to resume
+    if not resuming:
+        fh_out = open(outname, 'a')
+        fh_out.write("Model"+'\t'+"Replicate"+'\t'+"log-likelihood"+'\t'+"AIC"+'\t'+"chi-squared"+'\t'+"theta"+'\t'+"optimized_params({})".format(param_labels)+'\n')
+        fh_out.close()
+        if any(x != full_fidelity for x in round_fidelity):
+            fh_out = open(explorename, 'a')
+            fh_out.write("Model"+'\t'+"Replicate"+'\t'+"log-likelihood"+'\t'+"AIC"+'\t'+"chi-squared"+'\t'+"theta"+'\t'+"optimized_params({})".format(param_labels)+'\n')
+            fh_out.close()
+    #the checkpoint is started once the new sections are written, so a resumed run always has its own header above its rows
+    if resume:
+        checkpoint['seed'] = seed
+        write_checkpoint(checkpoint_name, checkpoint)
     
     #Create list to store sublists of [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values] for every replicate
     results_list = []
+
+    #the best log-likelihood of the round is shared with the worker processes so they can all prune against it
+    if prune_factor is not None:
+        round_best = multiprocessing.Value('d', float('-inf'))
+        init_pruning(round_best)
+        pool_args = (init_pruning, (round_best,))
+    else:
+        pool_args = ()
+
+    #start the worker processes if the replicates of each round are to be run in parallel
+    if workers is None:
+        pool = None
+    else:
+        pool = multiprocessing.Pool(int(workers), *pool_args)
+    #or start one process per grid size if those are to be evaluated at the same time instead
+    #(a single grid size has nothing to run alongside it, so no processes are started then)
+    if parallel_grids and max(len(x) for x in round_pts_list) > 1:
+        grid_pool = multiprocessing.Pool(max(len(x) for x in round_pts_list))
+    else:
+        grid_pool = None
     
     #for every round, execute the assigned number of replicates with other round-defined args (maxiter, fold, best_params)
     rounds = int(rounds)
     for r in range(rounds):
         print "\tBeginning Optimizations for Round {}:".format(r+1)
+        if round_fidelity[r] != full_fidelity:
+            print "\tExploratory round on grid sizes {0}, sample sizes {1}".format(round_pts_list[r], round_fidelity[r][1])
        
         #make sure first round params are assigned (either user input or auto generated)
         if r == int(0):
             best_params = params
-        #and that all subsequent rounds use the params from a previous best scoring replicate
+            seed_params = [params]
+        #and that all subsequent rounds use the params from a previous best scoring replicate, only comparing replicates
+        #run on the same grids and spectrum as the last round, as log-likelihoods on other grids or sample sizes differ
+        else:
+            previous = [x for x in results_list if replicate_fidelity(x[0]) == round_fidelity[r-1]]
+            best_params = previous[0][5]
+            #or the params of the best few distinct replicates, taking turns
+            if top_k is None:
+                seed_params = [best_params]
+            else:
+                distinct = distinct_optima(previous, top_k, top_k_distance, lower_bound)
+                seed_params = [x[5] for x in distinct]
+                print "\tStarting from {0} distinct replicates: {1}".format(len(distinct), ", ".join("{0} (ll = {1})".format(x[0], x[1]) for x in distinct))
+
+        #pruning is against the best of this round only
+        if prune_factor is not None:
+            round_best.value = float('-inf')
+
+        if timings:
+            round_timings = timing_rounds.setdefault(r+1, {'replicates':0, 'seconds':0.0, 'categories':{}})
+            tb_timing = time.time()
         else:
-            best_params = results_list[0][5]
+            round_timings = {'categories':None}
 
-        #perform an optimization routine for each rep number in this round number
+        #replicates are run in batches, so that in adaptive mode the round can be ended once its best scores agree
+        #without adaptive mode the whole round is one batch, and in adaptive mode the first batch is the reps replicates every round runs
+        if converge_k is None:
+            rep_limit = reps_list[r]
+            batch_size = rep_limit
+        else:
+            rep_limit = max_reps_list[r]
+            if pool is None:
+                batch_size = 1
+            else:
+                batch_size = int(workers)
+        #the first round can start from the best of many candidates, each evaluated once, unless it already finished
+        #a resumed run uses the candidates its prescreen kept rather than screening again
+        if r == 0 and prescreen is not None and resume and 'prescreen' in checkpoint:
+            start_params = checkpoint['prescreen']
+            print "\tUsing the {} pre-screened starts saved in the checkpoint\n".format(len(start_params))
+        elif r == 0 and prescreen is not None and not all("Round_1_Replicate_{}".format(x) in done for x in range(1, rep_limit+1)):
+            tb_step = time.time()
+            if start_design is not None:
+                candidates = design_starts(prescreen, lower_bound, upper_bound, start_design, derive_seed(seed, "prescreen"))
+            else:
+                candidates = []
+                for i in range(int(prescreen)):
+                    numpy.random.seed(derive_seed(seed, "prescreen", i+1))
+                    candidates.append(dadi.Misc.perturb_params(best_params, fold=folds_list[r], upper_bound=upper_bound, lower_bound=lower_bound))
+            #candidates are handed out in chunks, several to each process so none sits idle while others finish
+            if pool is not None:
+                screen_pool = pool
+                chunk = max(1, len(candidates) // (4 * int(workers)))
+            else:
+                screen_pool = grid_pool
+                chunk = max(1, len(candidates) // (4 * max(len(x) for x in round_pts_list)))
+            screen_jobs = [{'fs':round_fs_list[r], 'pts':round_pts_list[r], 'func':func, 'candidates':candidates[i:i+chunk]} for i in range(0, len(candidates), chunk)]
+            if screen_pool is None:
+                candidate_lls = list(itertools.chain.from_iterable(itertools.imap(screen_candidates, screen_jobs)))
+            else:
+                candidate_lls = list(itertools.chain.from_iterable(screen_pool.imap(screen_candidates, screen_jobs)))
+            if prescreen_keep is None:
+                keep = min(rep_limit, prescreen)
+            else:
+                keep = prescreen_keep
+            ranked = sorted(range(len(candidates)), key=lambda x: candidate_lls[x], reverse=True)[:keep]
+            start_params = [list(candidates[x]) for x in ranked]
+            screen_line = "Pre-screened {0} candidate starts, kept the best {1}, log-likelihoods {2} to {3}".format(len(candidates), len(start_params), candidate_lls[ranked[0]], candidate_lls[ranked[-1]])
+            print "\t{}\n".format(screen_line)
+            fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
+            fh_log.write("\n{}\n".format(screen_line))
+            fh_log.close()
+            if resume:
+                checkpoint['prescreen'] = start_params
+                write_checkpoint(checkpoint_name, checkpoint)
+            add_timing(round_timings['categories'], "prescreen", time.time() - tb_step)
+        #or from a design spread over the whole parameter space, drawn for every replicate at once
+        elif r == 0 and start_design is not None:
+            tb_step = time.time()
+            start_params = design_starts(rep_limit, lower_bound, upper_bound, start_design, derive_seed(seed, "design"))
+            add_timing(round_timings['categories'], "perturb", time.time() - tb_step)
+        else:
+            start_params = None
+        rep = 0
+        while rep < rep_limit:
+            #set up a job for each rep number in this batch
+            jobs = []
+            for rep in range(rep+1, min(max(rep+batch_size, reps_list[r]), rep_limit)+1):
+                #perturb starting parameters, from a stream of their own so they don't depend on where or in what order replicates run
+                tb_step = time.time()
+                rep_seed = derive_seed(seed, r+1, rep)
+                if start_params is None:
+                    numpy.random.seed(rep_seed)
+                    params_perturbed = dadi.Misc.perturb_params(seed_params[(rep-1) % len(seed_params)], fold=folds_list[r], upper_bound=upper_bound, lower_bound=lower_bound)
+                elif rep <= len(start_params):
+                    params_perturbed = start_params[rep-1]
+                else:
+                    numpy.random.seed(rep_seed)
+                    params_perturbed = dadi.Misc.perturb_params(start_params[(rep-1) % len(start_params)], fold=folds_list[r], upper_bound=upper_bound, lower_bound=lower_bound)
+                add_timing(round_timings['categories'], "perturb", time.time() - tb_step)
+
+                roundrep = "Round_{0}_Replicate_{1}".format(r+1, rep)
+                #replicates finished before the job was killed are not run again
+                if roundrep in done:
+                    print "\t\tRound {0} Replicate {1} of {2}: already finished, ll = {3}".format(r+1, rep, rep_limit, done[roundrep][1])
+                    results_list.append(done[roundrep])
+                    continue
+
+                jobs.append({'fs':round_fs_list[r], 'pts':round_pts_list[r], 'func':func, 'lower_bound':lower_bound, 'upper_bound':upper_bound,
+                             'maxiter':maxiters_list[r], 'params_perturbed':params_perturbed, 'roundrep':roundrep,
+                             'label':"Round {0} Replicate {1} of {2}".format(r+1, rep, rep_limit),
+                             'cache_size':cache_size, 'cache_dir':cache_dir, 'cache_dir_mb':cache_dir_mb,
+                             'grid_pool':grid_pool, 'seed':rep_seed, 'prune_factor':prune_factor, 'prune_after':prune_after,
+                             'trace':trace, 'timings':timings})
+
+            #pruning is against the best of this round only, replicates finished before a restart still count
+            if prune_factor is not None:
+                round_best.value = max([round_best.value] + [float(x[1]) for x in results_list if x[0].startswith("Round_{}_".format(r+1))])
+
+            #perform an optimization routine for each job, results come back in replicate order either way
+            if pool is None:
+                rep_iter = itertools.imap(run_replicate, jobs)
+            else:
+                rep_iter = pool.imap(run_replicate, jobs)
+
+            for job, (rep_results, rep_info) in itertools.izip(jobs, rep_iter):
+                tb_step = time.time()
+                #add the optimizer steps of this replicate to the bigger log file
+                write_log(outfile, model_name, rep_results, job['roundrep'], rep_info['log'], job['seed'])
+                
+                #append results from this sim to larger list
+                results_list.append(rep_results)
+                
+                #write all this info to our main results file, or the exploratory one
+                if round_fidelity[r] == full_fidelity:
+                    fh_out = open(outname, 'a')
+                else:
+                    fh_out = open(explorename, 'a')
+                #join the param values together with commas
+                easy_p = ",".join(str(numpy.around(x, 4)) for x in rep_results[5])
+                #replicates stopped early are marked, as their parameters are only the best they reached before being stopped
+                fh_out.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(model_name, replicate_label(rep_results[0], rep_info['pruned']), rep_results[1], rep_results[2], rep_results[3], rep_results[4], easy_p))
+                fh_out.close()
+                if conn is not None:
+                    write_results_db(conn, outfile, model_name, seed, rep_results, rep_info, job['seed'], param_labels, job['pts'], job['fs'])
+                #save its trace to a file of its own
+                if trace:
+                    write_trace(tracedir, job['roundrep'], rep_info['trace'])
+
+                #record the finished replicate in the checkpoint
+                if resume:
+                    checkpoint['results'][job['roundrep']] = rep_results
+                    write_checkpoint(checkpoint_name, checkpoint)
+
+                if timings:
+                    add_timing(round_timings['categories'], "file_io", time.time() - tb_step)
+                    merge_timings(round_timings['categories'], rep_info['timings'])
+                    round_timings['replicates'] += 1
+
+            #in adaptive mode, end the round once the best converge_k replicates of the round agree
+            if converge_k is not None and rep >= reps_list[r]:
+                round_lls = sorted([float(x[1]) for x in results_list if x[0].startswith("Round_{}_".format(r+1))], reverse=True)
+                if len(round_lls) >= converge_k and round_lls[0] - round_lls[converge_k-1] <= converge_tol:
+                    print "\tBest {0} replicates of round {1} are within {2} log-likelihood units after {3} replicates\n".format(converge_k, r+1, converge_tol, rep)
+                    break
+        else:
+            if converge_k is not None:
+                print "\tBest {0} replicates of round {1} did not converge within {2} replicates\n".format(converge_k, r+1, rep_limit)
+
+        #Now that this round is over, sort results in order of likelihood score, we'll use the parameters from the best rep to start the next round as the loop continues
+        results_list.sort(key=lambda x: float(x[1]), reverse=True)
+        best_rep = [x for x in results_list if replicate_fidelity(x[0]) == round_fidelity[r]][0]
+        print "\tBest so far: {0}, ll = {1}\n\n".format(best_rep[0], best_rep[1])
+
+        #save the timings with this round added
+        if timings:
+            round_timings['seconds'] += time.time() - tb_timing
+            write_timings(timingname, model_name, pts, timing_rounds)
+
+    #shut down the worker processes
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if grid_pool is not None:
+        grid_pool.close()
+        grid_pool.join()
+    if conn is not None:
+        conn.close()
+
+    #Now that all rounds are over, calculate elapsed time for the whole model
+    tf_round = datetime.now()
+    te_round = tf_round - tb_round
+    print "\n{0} Analysis Time for Model: {1} (H:M:S)\n\n============================================================================".format(model_name, te_round)
+
+    #the checkpoint is no longer needed once every round has finished
+    if resume and os.path.exists(checkpoint_name):
+        os.remove(checkpoint_name)
+
+def run_scheduled_replicate(job):
+    #--------------------------------------------------------------------------------------
+    # run one replicate for Optimize_Model_Set and return [model_name, replicate number, replicate], where
+    # replicate is the list returned by run_replicate, or the traceback as a string if the replicate failed
+    
+    # Arguments
+    # job: dictionary built by Optimize_Model_Set, with the keys used by run_replicate plus model_name and rep
+    #--------------------------------------------------------------------------------------
+    try:
+        return [job['model_name'], job['rep'], run_replicate(job)]
+    except Exception:
+        return [job['model_name'], job['rep'], traceback.format_exc()]
+
+def Optimize_Model_Set(fs, pts, outfile, model_specs, rounds, reps=None, maxiters=None, folds=None, workers=None, seed=None, cache_size=10, cache_dir=None, cache_dir_mb=1000, results_db=None):
+    #--------------------------------------------------------------------------------------
+    # Optimize a whole set of models at once, running the replicates of all the models through one pool of
+    # worker processes. Each model goes through its rounds as in Optimize_Routine and writes the same output
+    # files, but whenever a core is free it is given the most expensive replicate that is ready to run (the
+    # estimated cost is param_number * largest pts ^ number of populations * maxiter), so cheap models fill
+    # in around expensive ones and the set finishes in close to the total work divided by the number of cores.
+
+    # Mandatory Arguments =
+    #(1) fs:  spectrum object name
+    #(2) pts: grid size for extrapolation, list of three values
+    #(3) outfile:  prefix for output naming
+    #(4) model_specs: a list with one entry per model, each a list or tuple of
+    #     (model_name, func, param_number, in_upper, in_lower, param_labels), where the last three can be left off or None
+    #     ex. [("no_mig", Models_2D.no_mig, 3), ("sym_mig", Models_2D.sym_mig, 4, None, None, "nu1, nu2, m, T")]
+    #(5) rounds: number of optimization rounds to perform
+
+    # Optional Arguments =
+    #(6) reps: a list of integers controlling the number of replicates in each of the optimization rounds
+    #(7) maxiters: a list of integers controlling the maxiter argument in each of the optimization rounds
+    #(8) folds: a list of integers controlling the fold argument when perturbing input parameter values
+    #(9) workers: number of worker processes (default None uses all the cores); the model functions must be
+    #     defined at the top level of a script or module so they can be sent to the worker processes
+    #(10) seed: integer the seed of each model is derived from (default None draws one); the seed written to the log file
+    #     of a model can be given to Optimize_Routine to repeat the optimization of that model on its own
+    #(11) cache_size: number of model spectra kept in memory so repeated evaluations are not integrated again (default 10, 0 turns this off)
+    #(12) cache_dir: a directory where model spectra are also saved, so later runs and other scripts can reuse them (default None)
+    #(13) cache_dir_mb: size limit in megabytes for cache_dir, the least recently used spectra are removed past this (default 1000)
+    #(14) results_db: path to an SQLite file that every replicate is also added to, as in Optimize_Routine (default None)
+    #--------------------------------------------------------------------------------------
+
+    #call function that determines if our replicates, maxiter, and fold have been set or need to be generated for us
+    reps_list, maxiters_list, folds_list = parse_opt_settings(rounds, reps, maxiters, folds)
+    rounds = int(rounds)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = int(workers)
+
+    if seed is None:
+        seed = numpy.random.randint(0, 2**31 - 1)
+    seed = int(seed)
+
+    print "\n\n============================================================================\nModel set of {0} models on {1} workers, seed = {2}\n============================================================================".format(len(model_specs), workers, seed)
+
+    #start keeping track of time it takes to complete optimizations for the whole set
+    tb_set = datetime.now()
+
+    #set up the bounds, output files and running state of each model
+    npops = len(fs.sample_sizes)
+    models = collections.OrderedDict()
+    for spec in model_specs:
+        if not 3 <= len(spec) <= 6:
+            raise ValueError("Each model must be given as (model_name, func, param_number, in_upper, in_lower, param_labels): {}".format(spec))
+        model_name, func, param_number, in_upper, in_lower, param_labels = list(spec) + [None] * (6 - len(spec))
+        if model_name in models:
+            raise ValueError("Model name used more than once: {}".format(model_name))
+        if param_labels is None:
+            param_labels = " "
+        params, upper_bound, lower_bound = parse_params(param_number, None, in_upper, in_lower)
+        model = {'func':func, 'params':params, 'upper_bound':upper_bound, 'lower_bound':lower_bound,
+                 'cost':int(param_number) * max(pts)**npops, 'seed':derive_seed(seed, model_name),
+                 'outname':"{0}.{1}.optimized.txt".format(outfile, model_name), 'param_labels':param_labels, 'round':0,
+                 'jobs':{}, 'round_results':{}, 'results_list':[], 'tb':datetime.now()}
+        models[model_name] = model
+
+        # We need an output file that will store all summary info for each replicate, across rounds
+        fh_out = open(model['outname'], 'a')
+        fh_out.write("Model"+'\t'+"Replicate"+'\t'+"log-likelihood"+'\t'+"AIC"+'\t'+"chi-squared"+'\t'+"theta"+'\t'+"optimized_params({})".format(param_labels)+'\n')
+        fh_out.close()
+        fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
+        fh_log.write("\nSeed = {}\n".format(model['seed']))
+        fh_log.close()
+
+    #open the results store if replicates are to be added to one
+    if results_db is None:
+        conn = None
+    else:
+        conn = open_results_db(results_db)
+
+    #replicates ready to run, ordered by estimated cost with the most expensive first, and then in the order they were made
+    ready = []
+    job_order = itertools.count()
+    def queue_round(model_name):
+        model = models[model_name]
+        r = model['round']
+        #make sure first round params are assigned, and that all subsequent rounds use the params from a previous best scoring replicate
+        if r == 0:
+            best_params = model['params']
+        else:
+            best_params = model['results_list'][0][5]
+        model['jobs'] = {}
+        model['round_results'] = {}
         for rep in range(1, (reps_list[r]+1) ):
-            print "\t\tRound {0} Replicate {1} of {2}:".format(r+1, rep, (reps_list[r]))
-            
-            #keep track of start time for rep
-            tb_rep = datetime.now()
-            
-            #create an extrapolating function 
-            func_exec = dadi.Numerics.make_extrap_log_func(func)
-
-            
-            #perturb starting parameters
-            params_perturbed = dadi.Misc.perturb_params(best_params, fold=folds_list[r], upper_bound=upper_bound, lower_bound=lower_bound)
-
-            #optimize from perturbed parameters
-            params_opt = dadi.Inference.optimize_log_fmin(params_perturbed, fs, func_exec, pts, lower_bound=lower_bound, upper_bound=upper_bound, verbose=1, maxiter=maxiters_list[r], output_file = "{}.log.txt".format(model_name))
-            print "\t\t\tOptimized parameters = ", params_opt
-
-            #simulate the model with the optimized parameters
-            sim_model = func_exec(params_opt, fs.sample_sizes, pts)
-
-            #collect results into a list using function above - [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
+            #perturb starting parameters the same way as Optimize_Routine given the seed of this model
+            rep_seed = derive_seed(model['seed'], r+1, rep)
+            numpy.random.seed(rep_seed)
+            params_perturbed = dadi.Misc.perturb_params(best_params, fold=folds_list[r], upper_bound=model['upper_bound'], lower_bound=model['lower_bound'])
             roundrep = "Round_{0}_Replicate_{1}".format(r+1, rep)
-            rep_results = collect_results(fs, sim_model, params_opt, roundrep)
-            
-            #reproduce replicate log to bigger log file, because constantly re-written
-            write_log(outfile, model_name, rep_results, roundrep)
-            
+            job = {'fs':fs, 'pts':pts, 'func':model['func'], 'lower_bound':model['lower_bound'], 'upper_bound':model['upper_bound'],
+                   'maxiter':maxiters_list[r], 'params_perturbed':params_perturbed, 'roundrep':roundrep,
+                   'label':"{0} Round {1} Replicate {2} of {3}".format(model_name, r+1, rep, reps_list[r]),
+                   'cache_size':cache_size, 'cache_dir':cache_dir, 'cache_dir_mb':cache_dir_mb, 'grid_pool':None,
+                   'seed':rep_seed, 'prune_factor':None, 'prune_after':None, 'trace':False, 'timings':False,
+                   'model_name':model_name, 'rep':rep}
+            model['jobs'][rep] = job
+            heapq.heappush(ready, (-model['cost'] * maxiters_list[r], next(job_order), job))
+
+    for model_name in models:
+        queue_round(model_name)
+
+    #keep the result of a finished replicate, and once every replicate of the round is in, write them out in order
+    #and queue the next round of the model
+    def finish_replicate(model_name, rep, replicate):
+        model = models[model_name]
+        model['round_results'][rep] = replicate
+        if len(model['round_results']) < reps_list[model['round']]:
+            return
+
+        #the round of this model is over, write the replicates in order
+        for rep in sorted(model['round_results']):
+            job = model['jobs'][rep]
+            rep_results, rep_info = model['round_results'][rep]
+            #add the optimizer steps of this replicate to the bigger log file
+            write_log(outfile, model_name, rep_results, job['roundrep'], rep_info['log'], job['seed'])
+        
             #append results from this sim to larger list
-            results_list.append(rep_results)
-            
+            model['results_list'].append(rep_results)
+        
             #write all this info to our main results file
-            fh_out = open(outname, 'a')
+            fh_out = open(model['outname'], 'a')
             #join the param values together with commas
             easy_p = ",".join(str(numpy.around(x, 4)) for x in rep_results[5])
             fh_out.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(model_name, rep_results[0], rep_results[1], rep_results[2], rep_results[3], rep_results[4], easy_p))
             fh_out.close()
+            if conn is not None:
+                write_results_db(conn, outfile, model_name, model['seed'], rep_results, rep_info, job['seed'], model['param_labels'], pts, fs)
 
-            #calculate elapsed time for replicate
-            tf_rep = datetime.now()
-            te_rep = tf_rep - tb_rep
-            print "\n\t\t\tReplicate time: {0} (H:M:S)\n".format(te_rep)
+        #sort results in order of likelihood score, we'll use the parameters from the best rep to start the next round
+        model['results_list'].sort(key=lambda x: float(x[1]), reverse=True)
+        print "\t{0} Round {1} finished, best so far: {2}, ll = {3}\n".format(model_name, model['round']+1, model['results_list'][0][0], model['results_list'][0][1])
 
-        #Now that this round is over, sort results in order of likelihood score, we'll use the parameters from the best rep to start the next round as the loop continues
-        results_list.sort(key=lambda x: float(x[1]), reverse=True)
-        print "\tBest so far: {0}, ll = {1}\n\n".format(results_list[0][0], results_list[0][1])
+        model['round'] += 1
+        if model['round'] < rounds:
+            queue_round(model_name)
+        else:
+            te_model = datetime.now() - model['tb']
+            print "\n{0} finished after {1} (H:M:S)\n".format(model_name, te_model)
 
-    #Now that all rounds are over, calculate elapsed time for the whole model
-    tf_round = datetime.now()
-    te_round = tf_round - tb_round
-    print "\n{0} Analysis Time for Model: {1} (H:M:S)\n\n============================================================================".format(model_name, te_round)
+    #the pool runs jobs in the order they are given, so only as many jobs as there are workers are handed over at a time,
+    #and each free worker gets the most expensive replicate that is ready at that moment
+    pool = multiprocessing.Pool(workers)
+    #the pool quietly replaces a worker that dies (ex. killed for using too much memory) and its replicate never finishes,
+    #so the worker processes are checked while waiting, and the set is stopped if any of them changes
+    worker_pids = set(process.pid for process in pool._pool)
+    running = collections.OrderedDict()
+    while ready or running:
+        while ready and len(running) < workers:
+            cost, order, job = heapq.heappop(ready)
+            running[pool.apply_async(run_scheduled_replicate, (job,))] = job
+        
+        #wait a second at a time for a replicate to finish, which keeps the wait interruptible with ctrl-c
+        next(iter(running)).wait(1)
+        finished = [result for result in running if result.ready()]
+        if not finished:
+            if set(process.pid for process in pool._pool) != worker_pids:
+                pool.terminate()
+                raise RuntimeError("A worker process stopped while running: {}".format(", ".join("{0} {1}".format(job['model_name'], job['roundrep']) for job in running.values())))
+            continue
+        for result in finished:
+            job = running.pop(result)
+            #get raises any error from the pool itself, ex. a replicate whose results can't be sent back
+            try:
+                model_name, rep, replicate = result.get()
+            except Exception:
+                pool.terminate()
+                raise
+            if isinstance(replicate, basestring):
+                pool.terminate()
+                raise RuntimeError("Replicate {0} of model {1} failed:\n{2}".format(job['roundrep'], model_name, replicate))
+            finish_replicate(model_name, rep, replicate)
+
+    #shut down the worker processes
+    pool.close()
+    pool.join()
+    if conn is not None:
+        conn.close()
+
+    #Now that all models are over, calculate elapsed time for the whole set and list the best replicate of each model
+    tf_set = datetime.now()
+    te_set = tf_set - tb_set
+    print "\n\n============================================================================\nModel set Analysis Time: {0} (H:M:S)\n".format(te_set)
+    print "Model\tReplicate\tlog-likelihood\tAIC"
+    for model_name in sorted(models, key=lambda x: float(models[x]['results_list'][0][2])):
+        best_rep = models[model_name]['results_list'][0]
+        print "{0}\t{1}\t{2}\t{3}".format(model_name, best_rep[0], best_rep[1], best_rep[2])
+    print "============================================================================"
+
+#tables of projection coefficients made by projection_table, keyed on projection size, shared by every SNP and spectrum
+_projection_tables = {}
+
+def snps_file_signature(snps):
+    #--------------------------------------------------------------------------------------
+    # return [size, modification time, hash of the first megabyte] of a SNPs file, used to tell
+    # whether the binary copy made by Load_SNPs is still up to date
+    
+    # Arguments
+    # snps: path to the SNPs file
+    #--------------------------------------------------------------------------------------
+    stat = os.stat(snps)
+    fh_snps = open(snps, 'rb')
+    head = fh_snps.read(2**20)
+    fh_snps.close()
+    return [stat.st_size, stat.st_mtime, hashlib.sha1(head).hexdigest()]
+
+def parse_snps_chunk(lines, allele2_index, npops):
+    #--------------------------------------------------------------------------------------
+    # convert lines of a SNPs file (in the format read by dadi.Misc.make_data_dict) to arrays, returning
+    # [allele1 calls, allele2 calls, polarity], where the calls have one column per population and polarity
+    # is 1 if the outgroup allele is Allele1, 2 if it is Allele2, and 0 if the SNP can't be polarized
+    
+    # Arguments
+    # lines: list of lines from the SNPs file, without the header or comment lines
+    # allele2_index: index of the Allele2 column
+    # npops: number of populations in the file
+    #--------------------------------------------------------------------------------------
+    rows = numpy.array([line.split()[:allele2_index+npops+1] for line in lines])
+    calls1 = rows[:, 3:allele2_index].astype(numpy.int32)
+    calls2 = rows[:, allele2_index+1:].astype(numpy.int32)
+    #the outgroup allele is the middle base of the outgroup context, ex. "A" for "CAT"
+    outgroup = numpy.char.upper(numpy.ascontiguousarray(rows[:, 1]).view('S1').reshape(len(rows), -1)[:, 1])
+    allele1 = numpy.char.upper(rows[:, 2])
+    allele2 = numpy.char.upper(rows[:, allele2_index])
+    polarity = numpy.zeros(len(rows), dtype=numpy.int8)
+    polarity[outgroup == allele2] = 2
+    polarity[outgroup == allele1] = 1
+    polarity[outgroup == '-'] = 0
+    return [calls1, calls2, polarity]
+
+def open_snps_file(snps):
+    #--------------------------------------------------------------------------------------
+    # open a SNPs file (optionally gzipped) and return [file handle, index of the Allele2 column, population names],
+    # with the file handle positioned after the header
+    
+    # Arguments
+    # snps: path to the SNPs file
+    #--------------------------------------------------------------------------------------
+    if snps.endswith('.gz'):
+        fh_snps = gzip.open(snps)
+    else:
+        fh_snps = open(snps)
+    # Skip to the header
+    header = fh_snps.readline()
+    while header.startswith('#'):
+        header = fh_snps.readline()
+    allele2_index = header.split().index('Allele2')
+    pop_ids = header.split()[3:allele2_index]
+    return [fh_snps, allele2_index, pop_ids]
+
+def superseded_snp_lines(snps, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # return the set of SNP lines (numbered from 0, not counting the header, comments and blank lines) that
+    # dadi.Misc.make_data_dict leaves out, because a later line has the same name in the columns after
+    # the Allele2 calls (usually Gene and Position) and replaces it in the dictionary;
+    # rather than a dictionary of every name, only a 64-bit hash of each name is kept (8 bytes per SNP,
+    # about 16 bytes per SNP at the peak while the hashes are sorted, ex. ~160 MB for 10 million SNPs),
+    # repeated hashes are found by sorting, and the names of just those lines are read again and compared,
+    # so two names that happen to share a hash are not mistaken for each other
+    
+    # Arguments
+    # snps: path to the SNPs file
+    # chunk_size: number of lines hashed at a time
+    #--------------------------------------------------------------------------------------
+    fh_snps, allele2_index, pop_ids = open_snps_file(snps)
+    name_start = allele2_index + len(pop_ids) + 1
+
+    def snp_names(fh_snps):
+        for line in fh_snps:
+            if line.strip() and not line.startswith('#'):
+                yield '_'.join(line.split()[name_start:])
+
+    #make_data_dict names unnamed SNPs by their line, so those are never replaced
+    hash_chunks = []
+    named_chunks = []
+    names = snp_names(fh_snps)
+    for chunk in iter(lambda: list(itertools.islice(names, chunk_size)), []):
+        hash_chunks.append(numpy.fromiter((hash(snp_id) for snp_id in chunk), dtype=numpy.int64, count=len(chunk)))
+        named_chunks.append(numpy.fromiter((bool(snp_id) for snp_id in chunk), dtype=bool, count=len(chunk)))
+    fh_snps.close()
+    if not hash_chunks:
+        return set()
+    hashes = numpy.concatenate(hash_chunks)
+    named = numpy.concatenate(named_chunks)
+    del hash_chunks, named_chunks
+
+    sorted_hashes = numpy.sort(hashes[named])
+    repeated = numpy.unique(sorted_hashes[1:][sorted_hashes[1:] == sorted_hashes[:-1]])
+    del sorted_hashes
+    if len(repeated) == 0:
+        return set()
+    candidates = set(numpy.nonzero(named & numpy.in1d(hashes, repeated))[0].tolist())
+    del hashes, named
+
+    #the lines that may share a name are read again, to compare the names themselves
+    fh_snps, allele2_index, pop_ids = open_snps_file(snps)
+    last_line = {}
+    superseded = set()
+    for line_number, snp_id in enumerate(snp_names(fh_snps)):
+        if line_number in candidates:
+            if snp_id in last_line:
+                superseded.add(last_line[snp_id])
+            last_line[snp_id] = line_number
+    fh_snps.close()
+    return superseded
+
+def read_snps_file(snps, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # open a SNPs file (the format used by dadi.Misc.make_data_dict, optionally gzipped) and return
+    # [population names, iterator], where the iterator gives the arrays made by parse_snps_chunk
+    # for chunk_size lines at a time, so the whole file is never held in memory; as with make_data_dict,
+    # only the last of several lines with the same Gene and Position is used (see superseded_snp_lines)
+    
+    # Arguments
+    # snps: path to the SNPs file
+    # chunk_size: number of lines parsed at a time
+    #--------------------------------------------------------------------------------------
+    superseded = superseded_snp_lines(snps, chunk_size)
+    if superseded:
+        print "{0} lines of {1} are left out, a later line has the same Gene and Position".format(len(superseded), snps)
+    fh_snps, allele2_index, pop_ids = open_snps_file(snps)
+
+    def chunks():
+        line_number = 0
+        for lines in iter(lambda: list(itertools.islice(fh_snps, chunk_size)), []):
+            lines = [line for line in lines if line.strip() and not line.startswith('#')]
+            if superseded:
+                kept = [line for i, line in enumerate(lines, line_number) if i not in superseded]
+            else:
+                kept = lines
+            line_number += len(lines)
+            if kept:
+                yield parse_snps_chunk(kept, allele2_index, len(pop_ids))
+        fh_snps.close()
+    return [pop_ids, chunks()]
+
+def Load_SNPs(snps, cache_dir=None, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # read a SNPs file (the format used by dadi.Misc.make_data_dict) into a dictionary of arrays:
+    #   pop_ids: population names, in the order of the file columns
+    #   calls1, calls2: number of Allele1 and Allele2 calls for each SNP (rows) and population (columns)
+    #   polarity: 1 if the outgroup allele is Allele1, 2 if it is Allele2, 0 if the SNP can't be polarized
+    # the first time a file is read it is parsed in chunks and the arrays are saved in cache_dir, after
+    # that they are memory-mapped from there, until the size, modification time or first megabyte of the file changes;
+    # if cache_dir can't be written to (ex. a read-only data directory), the path of the SNPs file is returned instead,
+    # which Spectrum_From_SNPs and Projection_Scan then read through again each time
+    
+    # Arguments
+    # snps: path to the SNPs file
+    # cache_dir: directory for the binary copy of the SNPs file (default None uses "snps.cache" next to the file)
+    # chunk_size: number of lines parsed at a time, which limits the memory used while parsing
+    #--------------------------------------------------------------------------------------
+    if cache_dir is None:
+        cache_dir = "{}.cache".format(snps)
+    index_name = os.path.join(cache_dir, "index.pkl")
+    signature = snps_file_signature(snps)
+
+    #use the binary copy if it was made from this version of the file
+    index = None
+    if os.path.exists(index_name):
+        fh_index = open(index_name, 'rb')
+        index = cPickle.load(fh_index)
+        fh_index.close()
+        if index['signature'] != signature:
+            index = None
+
+    if index is None:
+        print "\nParsing {0}, saving the allele counts to {1}".format(snps, cache_dir)
+        tb_parse = datetime.now()
+        names = ['calls1', 'calls2', 'polarity']
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            pop_ids, snp_chunks = read_snps_file(snps, chunk_size)
+
+            #each array is written out a chunk at a time as raw binary, to temporary files named for this process
+            #so that several jobs parsing the same file at once don't write over each other's copies
+            tag = "{0}.{1}".format(os.getpid(), uuid.uuid4().hex)
+            fh_bins = [open(os.path.join(cache_dir, "{0}.bin.{1}.tmp".format(x, tag)), 'wb') for x in names]
+            nsnps = 0
+            for chunk in snp_chunks:
+                for fh_bin, array in zip(fh_bins, chunk):
+                    array.tofile(fh_bin)
+                nsnps += len(chunk[2])
+            for fh_bin, name in zip(fh_bins, names):
+                fh_bin.close()
+                os.rename(os.path.join(cache_dir, "{0}.bin.{1}.tmp".format(name, tag)), os.path.join(cache_dir, "{}.bin".format(name)))
+
+            #the index is written last, so a copy is only used once it is complete
+            index = {'signature':signature, 'pop_ids':pop_ids, 'nsnps':nsnps}
+            fh_index = open("{0}.{1}.tmp".format(index_name, tag), 'wb')
+            cPickle.dump(index, fh_index, 2)
+            fh_index.close()
+            os.rename("{0}.{1}.tmp".format(index_name, tag), index_name)
+        #without somewhere to keep the binary copy, the SNPs file is read through each time it is used instead
+        except (OSError, IOError) as error:
+            print "Could not save the allele counts to {0} ({1}), {2} will be read again each time it is used\n".format(cache_dir, error, snps)
+            return snps
+        print "Parsed {0} SNPs in {1} (H:M:S)\n".format(nsnps, datetime.now() - tb_parse)
+
+    snp_data = {'pop_ids':index['pop_ids']}
+    npops = len(index['pop_ids'])
+    for name, dtype, shape in [('calls1', numpy.int32, (index['nsnps'], npops)), ('calls2', numpy.int32, (index['nsnps'], npops)), ('polarity', numpy.int8, (index['nsnps'],))]:
+        if index['nsnps'] == 0:
+            snp_data[name] = numpy.zeros(shape, dtype=dtype)
+        else:
+            snp_data[name] = numpy.memmap(os.path.join(cache_dir, "{}.bin".format(name)), dtype=dtype, mode='r', shape=shape)
+    return snp_data
+
+def log_comb(n, k):
+    #--------------------------------------------------------------------------------------
+    # log of n choose k for arrays of n and k, -inf where k is below 0 or above n
+    #--------------------------------------------------------------------------------------
+    n, k = numpy.broadcast_arrays(numpy.asarray(n, dtype=float), numpy.asarray(k, dtype=float))
+    result = numpy.full(n.shape, -numpy.inf)
+    valid = (k >= 0) & (k <= n)
+    result[valid] = gammaln(n[valid]+1) - gammaln(k[valid]+1) - gammaln(n[valid]-k[valid]+1)
+    return result
+
+def projection_table(proj_to, max_called):
+    #--------------------------------------------------------------------------------------
+    # return the table W[called, derived, j] of hypergeometric probabilities of seeing j derived alleles when
+    # proj_to alleles are drawn from the alleles called, of which derived are derived, for every number of alleles
+    # called up to at least max_called (zero where fewer than proj_to alleles were called)
+    # the table is made once per projection size and reused for every SNP and every spectrum after that
+    
+    # Arguments
+    # proj_to: the projection size
+    # max_called: largest number of alleles called for any SNP
+    #--------------------------------------------------------------------------------------
+    if proj_to not in _projection_tables or len(_projection_tables[proj_to]) <= max_called:
+        called, derived, proj_hits = numpy.ogrid[0:max_called+1, 0:max_called+1, 0:proj_to+1]
+        #worked out in logs so large sample sizes don't overflow, impossible draws come out as exp(-inf) = 0
+        old_settings = numpy.seterr(invalid='ignore', under='ignore')
+        table = numpy.exp(log_comb(proj_to, proj_hits) + log_comb(called-proj_to, derived-proj_hits) - log_comb(called, derived))
+        numpy.seterr(**old_settings)
+        table[numpy.isnan(table) | (numpy.broadcast_to(called, table.shape) < proj_to)] = 0.
+        _projection_tables[proj_to] = table
+    return _projection_tables[proj_to]
+
+def count_snp_patterns(called, derived):
+    #--------------------------------------------------------------------------------------
+    # collapse SNPs with the same alleles called and derived alleles called in every population into one pattern,
+    # returning [called, derived, counts] with one row per distinct pattern and the number of SNPs sharing it,
+    # so the projection work depends on the number of distinct patterns rather than the number of SNPs
+    
+    # Arguments
+    # called: alleles called for each SNP (rows) and population (columns)
+    # derived: derived alleles called for each SNP (rows) and population (columns)
+    #--------------------------------------------------------------------------------------
+    npops = called.shape[1]
+    snp_patterns = numpy.hstack([called, derived])
+    #sorting one number per SNP is much faster than sorting rows, so each pattern is packed into a single
+    #integer when it fits, with a digit in base (most alleles called + 1) for each column
+    base = int(snp_patterns.max()) + 1
+    if base ** snp_patterns.shape[1] < 2**62:
+        keys = numpy.zeros(len(snp_patterns), dtype=numpy.int64)
+        for column in snp_patterns.T:
+            keys = keys * base + column
+        keys, first, counts = numpy.unique(keys, return_index=True, return_counts=True)
+        patterns = snp_patterns[first]
+    else:
+        patterns, counts = numpy.unique(snp_patterns, axis=0, return_counts=True)
+    return [patterns[:, :npops], patterns[:, npops:], counts]
+
+def add_snps_to_spectrum(fs_total, calls1, calls2, polarity, projections, polarized):
+    #--------------------------------------------------------------------------------------
+    # project a chunk of SNPs down to the projection sizes and add them to a spectrum array, in place
+    
+    # Arguments
+    # fs_total: array of shape projections+1 the SNPs are added to
+    # calls1, calls2: Allele1 and Allele2 calls of the SNPs, one column per population in the order of projections
+    # polarity: 1 if the outgroup allele is Allele1, 2 if it is Allele2, 0 if the SNP can't be polarized
+    # projections: projection sizes, in ALLELES not individuals, one per population
+    # polarized: if True, SNPs that can't be polarized are left out
+    #--------------------------------------------------------------------------------------
+    #the derived allele is the one that differs from the outgroup, or Allele2 if the SNP isn't polarized
+    called = calls1 + calls2
+    derived = numpy.where((polarity == 2)[:, numpy.newaxis], calls1, calls2)
+
+    if polarized:
+        called, derived = called[polarity != 0], derived[polarity != 0]
+    if len(called) == 0:
+        return
+    called, derived, counts = count_snp_patterns(called, derived)
+
+    #look up the projection coefficients of every pattern in each population, and add the products across
+    #populations of all the patterns, times their counts, to the spectrum at once, ex. "za,zb->ab" for two populations
+    max_called = int(called.max())
+    weights = [projection_table(proj_to, max_called)[called[:, i], derived[:, i]] for i, proj_to in enumerate(projections)]
+    weights[0] = weights[0] * counts[:, numpy.newaxis]
+    pop_letters = "abcdefghij"[:len(projections)]
+    subscripts = "{0}->{1}".format(",".join("z"+x for x in pop_letters), pop_letters)
+    fs_total += numpy.einsum(subscripts, *weights, optimize=True)
+
+def Spectrum_From_SNPs(snp_data, pop_ids, projections, polarized=True, mask_corners=True, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # build a frequency spectrum from a SNPs file, giving the same spectrum as
+    # dadi.Spectrum.from_data_dict(dadi.Misc.make_data_dict(snps), pop_ids, projections, mask_corners, polarized),
+    # including leaving out lines replaced by a later line with the same Gene and Position
+    # the SNPs are projected and added to the spectrum chunk_size at a time, so the memory used
+    # depends on the chunk size rather than the number of SNPs
+    
+    # Arguments
+    # snp_data: the dictionary returned by Load_SNPs, or the path to a SNPs file to stream through without saving a binary copy
+    # pop_ids: list of the populations to include, which should match the population headers of the SNPs file
+    # projections: projection sizes, in ALLELES not individuals, one per population
+    # polarized: if True, only SNPs polarized by the outgroup are used; if False, all are used and the spectrum is folded
+    # mask_corners: if True, the 'observed in none' and 'observed in all' entries of the spectrum are masked
+    # chunk_size: number of SNPs projected at a time
+    #--------------------------------------------------------------------------------------
+    if isinstance(snp_data, basestring):
+        file_pop_ids, snp_chunks = read_snps_file(snp_data, chunk_size)
+    else:
+        file_pop_ids = snp_data['pop_ids']
+        nsnps = len(snp_data['polarity'])
+        snp_chunks = ([snp_data['calls1'][i:i+chunk_size], snp_data['calls2'][i:i+chunk_size], snp_data['polarity'][i:i+chunk_size]] for i in xrange(0, nsnps, chunk_size))
+    cols = [file_pop_ids.index(pop) for pop in pop_ids]
+
+    fs_total = numpy.zeros(numpy.array(projections)+1)
+    for calls1, calls2, polarity in snp_chunks:
+        add_snps_to_spectrum(fs_total, numpy.asarray(calls1)[:, cols], numpy.asarray(calls2)[:, cols], numpy.asarray(polarity), projections, polarized)
+
+    fs = dadi.Spectrum(fs_total, mask_corners=mask_corners, pop_ids=pop_ids)
+    if not polarized:
+        fs = fs.fold()
+    return fs
+
+def projection_end_tables(proj_to, max_called):
+    #--------------------------------------------------------------------------------------
+    # return [none, all], two tables indexed by [alleles called, derived alleles called] holding the probability
+    # that none, or all, of the proj_to alleles drawn are derived, taken from projection_table; entries where
+    # fewer than proj_to alleles were called are set to none = 1 and all = 0
+    
+    # Arguments
+    # proj_to: the projection size
+    # max_called: largest number of alleles called for any SNP
+    #--------------------------------------------------------------------------------------
+    table = projection_table(proj_to, max_called)
+    none_derived = table[:, :, 0].copy()
+    all_derived = table[:, :, proj_to].copy()
+    none_derived[:proj_to] = 1.
+    return [none_derived, all_derived]
+
+def count_segregating_sites(scan_job):
+    #--------------------------------------------------------------------------------------
+    # return the expected number of segregating sites, S(), of the spectrum projected to each candidate projection
+    # for a chunk of SNPs, this is the unit of work handed to the worker pool by Projection_Scan
+    
+    # Arguments
+    # scan_job: [called, derived, counts, candidates], the alleles called and derived alleles called of each
+    #           pattern of SNPs (one column per population), the number of SNPs with each pattern, and a list of candidate projections
+    #--------------------------------------------------------------------------------------
+    called, derived, counts, candidates = scan_job
+    max_called = int(called.max()) if called.size else 0
+    sites = []
+    for projection in candidates:
+        #a SNP adds to S with the probability that the alleles drawn are neither all ancestral nor all derived
+        #in every population, and not at all if too few alleles were called in any of them
+        none_derived = numpy.ones(len(called))
+        all_derived = numpy.ones(len(called))
+        projectable = numpy.ones(len(called), dtype=bool)
+        for i, proj_to in enumerate(projection):
+            none_table, all_table = projection_end_tables(proj_to, max_called)
+            none_derived *= none_table[called[:, i], derived[:, i]]
+            all_derived *= all_table[called[:, i], derived[:, i]]
+            projectable &= called[:, i] >= proj_to
+        sites.append(numpy.sum((counts * (1. - none_derived - all_derived))[projectable]))
+    return sites
+
+def Projection_Scan(snp_data, pop_ids, proj_ranges, outfile, polarized=False, workers=None, chunk_size=100000):
+    #--------------------------------------------------------------------------------------
+    # find the number of segregating sites, S(), for every combination of candidate projection sizes in a single pass
+    # over the SNPs, to help choose the projection, and write:
+    #   outfile.projections.txt: every combination of projection sizes and its S(), sorted from most to fewest sites
+    #   outfile.best_projections.txt: for each population on its own, every candidate size and its S(), and the best size
+    
+    # Arguments
+    # snp_data: the dictionary returned by Load_SNPs, or the path to a SNPs file
+    # pop_ids: list of the populations to include, which should match the population headers of the SNPs file
+    # proj_ranges: a list with the candidate projection sizes of each population, in ALLELES not individuals,
+    #              ex. [range(14,20,2), range(20,38,2)]
+    # outfile: prefix for output naming
+    # polarized: if True, only SNPs polarized by the outgroup are counted (default False counts all, as for a folded spectrum)
+    # workers: number of processes the candidate projections are split across (default None uses one)
+    # chunk_size: number of SNPs handled at a time
+    #--------------------------------------------------------------------------------------
+    print "\n\n============================================================================\nProjection scan for {}\n============================================================================".format(", ".join(pop_ids))
+    tb_scan = datetime.now()
+
+    #every combination of candidate sizes, and each population on its own
+    candidates = list(itertools.product(*proj_ranges))
+    if workers is None:
+        pool = None
+        workers = 1
+    else:
+        workers = int(workers)
+        pool = multiprocessing.Pool(workers)
+    candidate_sets = [candidates[i::workers] for i in range(workers)]
+
+    if isinstance(snp_data, basestring):
+        file_pop_ids, snp_chunks = read_snps_file(snp_data, chunk_size)
+    else:
+        file_pop_ids = snp_data['pop_ids']
+        nsnps = len(snp_data['polarity'])
+        snp_chunks = ([snp_data['calls1'][i:i+chunk_size], snp_data['calls2'][i:i+chunk_size], snp_data['polarity'][i:i+chunk_size]] for i in xrange(0, nsnps, chunk_size))
+    cols = [file_pop_ids.index(pop) for pop in pop_ids]
+
+    sites = numpy.zeros(len(candidates))
+    single_sites = [numpy.zeros(len(x)) for x in proj_ranges]
+    for calls1, calls2, polarity in snp_chunks:
+        calls1 = numpy.asarray(calls1)[:, cols]
+        calls2 = numpy.asarray(calls2)[:, cols]
+        polarity = numpy.asarray(polarity)
+        if polarized:
+            calls1, calls2, polarity = calls1[polarity != 0], calls2[polarity != 0], polarity[polarity != 0]
+        if len(polarity) == 0:
+            continue
+        called = calls1 + calls2
+        derived = numpy.where((polarity == 2)[:, numpy.newaxis], calls1, calls2)
+        called, derived, counts = count_snp_patterns(called, derived)
+
+        #split the candidates across the workers, the results come back in the same order they were split
+        scan_jobs = [[called, derived, counts, x] for x in candidate_sets]
+        if pool is None:
+            set_sites = map(count_segregating_sites, scan_jobs)
+        else:
+            set_sites = pool.map(count_segregating_sites, scan_jobs)
+        for i in range(workers):
+            sites[i::workers] += set_sites[i]
+
+        #each population on its own
+        for i in range(len(pop_ids)):
+            single_sites[i] += count_segregating_sites([called[:, i:i+1], derived[:, i:i+1], counts, [[x] for x in proj_ranges[i]]])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    #write the table of every combination, most segregating sites first
+    order = numpy.argsort(-sites, kind='mergesort')
+    fh_out = open("{}.projections.txt".format(outfile), 'w')
+    fh_out.write("Projection({})".format(",".join(pop_ids))+'\t'+"Segregating_sites"+'\n')
+    for i in order:
+        fh_out.write("{0}\t{1}\n".format(",".join(str(x) for x in candidates[i]), numpy.around(sites[i], 2)))
+    fh_out.close()
+
+    #write the scan of each population on its own, and its best projection size
+    fh_out = open("{}.best_projections.txt".format(outfile), 'w')
+    fh_out.write("Population"+'\t'+"Projection"+'\t'+"Segregating_sites"+'\n')
+    print "Best projection for each population on its own:"
+    for i, pop in enumerate(pop_ids):
+        for proj_to, pop_sites in zip(proj_ranges[i], single_sites[i]):
+            fh_out.write("{0}\t{1}\t{2}\n".format(pop, proj_to, numpy.around(pop_sites, 2)))
+        best = numpy.argmax(single_sites[i])
+        fh_out.write("{0}\tBest={1}\t{2}\n".format(pop, proj_ranges[i][best], numpy.around(single_sites[i][best], 2)))
+        print "\t{0}: {1} alleles, {2} segregating sites".format(pop, proj_ranges[i][best], numpy.around(single_sites[i][best], 2))
+    fh_out.close()
+
+    print "\nBest combination: {0}, {1} segregating sites".format(",".join(str(x) for x in candidates[order[0]]), numpy.around(sites[order[0]], 2))
+    print "\nProjection scan time: {0} (H:M:S)\n============================================================================".format(datetime.now() - tb_scan)
 
-    #cleanup file
-    os.remove("{}.log.txt".format(model_name))
+    return [[candidates[i], sites[i]] for i in order]
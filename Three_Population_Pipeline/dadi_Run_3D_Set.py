@@ -89,8 +89,15 @@ Updated May 2018
 #**************
 snps = "/Users/dan/dadi_pipeline/Three_Population_Pipeline/Example_Input_File/dadi_3pops_CVLS_CVLN_Cross_snps.txt"
 
-#Create python dictionary from snps file
-dd = dadi.Misc.make_data_dict(snps)
+#**************
+#folder for a binary copy of the snps file, None puts it next to the snps file (as "snps.cache"),
+#give a folder you can write to if the snps file is in a read-only or shared directory
+cache_dir = None
+
+#Read the allele counts from the snps file, the first time a binary copy is saved in cache_dir,
+#which later runs load instead for as long as the snps file is unchanged; if the copy can't be
+#saved, the snps file is read through again whenever it is used
+snp_data = Optimize_Functions.Load_SNPs(snps, cache_dir=cache_dir)
 
 #**************
 #pop_ids is a list which should match the populations headers of your SNPs file columns
@@ -100,9 +107,9 @@ pop_ids=['CVLS','CVLN','Cross']
 #projection sizes, in ALLELES not individuals
 proj = [14,30,18]
 
-#Convert this dictionary into folded AFS object
+#Convert the allele counts into folded AFS object
 #[polarized = False] creates folded spectrum object
-fs = dadi.Spectrum.from_data_dict(dd, pop_ids=pop_ids, projections = proj, polarized = False)
+fs = Optimize_Functions.Spectrum_From_SNPs(snp_data, pop_ids=pop_ids, projections = proj, polarized = False)
 
 #print some useful information about the afs or jsfs
 print "\n\n============================================================================\nData for site frequency spectrum\n============================================================================\n"
@@ -149,7 +156,9 @@ Round4 - 40 replicates, maxiter = 15, fold = 1
 If this script was run as is, each model would be called and optimized sequentially;
 this could take a very long time. For your actual analyses, I strongly recommend
 creating multiple scripts with only a few models each and running them
-independently. It is also not a good idea to mix models from the Diversification Set
+independently, or passing a list of the models to Optimize_Model_Set, which
+optimizes all of them at the same time on a pool of worker processes (see the
+README in the main folder). It is also not a good idea to mix models from the Diversification Set
 and the Island Set, as each was meant to be mutually exclusive.
 
 '''
@@ -1,8 +1,10 @@
 import sys
 import os
-import shutil
+import heapq
+import cPickle
+import multiprocessing
 '''
-usage: python Summarize_Outputs.py [full path to directory with results files]
+usage: python Summarize_Outputs.py [full path to directory with results files] [optional: number of processes]
 
 example: python Summarize_Outputs.py users/dan/moments_analyses/results/
 
@@ -20,7 +22,12 @@ Two summary files will be produced:
     This is essentially a simplified version of the above file, and only contains the
     top scoring replicate per model and it is already sorted in order of AIC.
 
-You should probably inspect that the top-scoring replicates were ERROR-FREE. 
+Both files are replaced every time the script is run. The results files are read
+in parallel (by default one process per core, or the number given after the directory),
+and the top five replicates of each file are kept in a cache (Results_Summary.cache.pkl),
+so running the script again only reads the results files that have changed since.
+
+You should probably inspect that the top-scoring replicates were ERROR-FREE.
 Often errors are logged on screen and log-likelihoods are still produced.
 
 -------------------------
@@ -33,73 +40,112 @@ https://github.com/dportik
 May 2018
 '''
 
-#===========================================================================
-file_dir = sys.argv[1]
-os.chdir(file_dir)
-
-#initiate empty lists that we will fill with summary information
-summary_list = []
-simple_list = []
-
-
-#search working directory
-for filetype in os.listdir('.'):
-    #find output files by extension name
-    if filetype.endswith(".optimized.txt"):
-        #now to get contents into an empty list
-        content = []
-        #open file
-        fh_temp = open(filetype, 'r')
-        print "Examining file {}".format(filetype)
-        #read lines into memory
-        lines = fh_temp.readlines()
-        #iterate over lines but skip header line
-        for line in lines[1:]:
-            line = line.strip()
-            line_items = line.split('\t')
-            content.append(line_items)
-        #close file
-        fh_temp.close()
-        
-        #content list items will have order: "Model"	"Replicate"	"log-likelihood"	"AIC"	"chi-squared"	"theta"	"optimized_params(xxx)"
-        #let's sort all the rows by AIC, lowest to highest
-        content.sort(key=lambda x: float(x[3]))
-        
+def file_signature(filename):
+    #the size and modification time of a results file, used to tell whether it changed since it was cached
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+def read_rows(filename):
+    #yield the rows of a results file one at a time, skipping the header lines that start each run and any blank lines
+    fh_temp = open(filename, 'r')
+    for line in fh_temp:
+        line = line.strip()
+        if not line or line.startswith("Model\t"):
+            continue
+        yield line.split('\t')
+    fh_temp.close()
+
+def summarize_file(filename):
+    #return [filename, signature, top five rows by AIC], keeping only five rows in memory at a time
+    print "Examining file {}".format(filename)
+    signature = file_signature(filename)
+    #content rows will have order: "Model"	"Replicate"	"log-likelihood"	"AIC"	"chi-squared"	"theta"	"optimized_params(xxx)"
+    top_rows = heapq.nsmallest(5, read_rows(filename), key=lambda x: float(x[3]))
+    return [filename, signature, top_rows]
+
+def write_summary(outname, rows):
+    #write a tab-delimited summary file, replacing the old one only once the new one is complete
+    tempname = "{}.tmp".format(outname)
+    fh_out = open(tempname, 'w')
+    fh_out.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params\n")
+    for row in rows:
+        for val in row:
+            fh_out.write("{}\t".format(val))
+        fh_out.write("\n")
+    fh_out.close()
+    os.rename(tempname, outname)
+
+def main(file_dir, workers=None):
+    #summarize the results files in file_dir, reading changed files on workers processes (default one per core)
+    os.chdir(file_dir)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    #load the top rows of each results file found last time, if the script was run here before
+    cache_name = "Results_Summary.cache.pkl"
+    if os.path.exists(cache_name):
+        fh_cache = open(cache_name, 'rb')
+        cache = cPickle.load(fh_cache)
+        fh_cache.close()
+    else:
+        cache = {}
+
+    #search working directory for output files by extension name, only reading those that are new or changed
+    filenames = sorted([x for x in os.listdir('.') if x.endswith(".optimized.txt")])
+    changed = [x for x in filenames if x not in cache or cache[x][0] != file_signature(x)]
+    print "{0} results files, {1} new or changed since the last summary".format(len(filenames), len(changed))
+
+    if len(changed) > 1 and workers > 1:
+        pool = multiprocessing.Pool(min(workers, len(changed)))
+        summaries = pool.imap_unordered(summarize_file, changed)
+    else:
+        pool = None
+        summaries = (summarize_file(x) for x in changed)
+    for filename, signature, top_rows in summaries:
+        cache[filename] = [signature, top_rows]
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    #files that are no longer in the directory are dropped from the cache
+    cache = dict((x, cache[x]) for x in filenames)
+    tempname = "{}.tmp".format(cache_name)
+    fh_cache = open(tempname, 'wb')
+    cPickle.dump(cache, fh_cache, 2)
+    fh_cache.close()
+    os.rename(tempname, cache_name)
+
+    #initiate empty lists that we will fill with summary information
+    summary_list = []
+    simple_list = []
+    for filename in filenames:
+        top_rows = cache[filename][1]
+        if not top_rows:
+            print "No replicates found in {}".format(filename)
+            continue
         #add top five entries to summary list
-        for i in content[:5]:
-            summary_list.append(i)
+        summary_list.extend(top_rows)
         #add top entry to easy list
-        simple_list.append(content[0])
-   
-#sort the list containing only the top entry for each model by order of AIC
-simple_list.sort(key=lambda x: float(x[3]))
-
-#create output file 1
-out1 = "Results_Summary_Extended.txt"
-fh_out1 = open(out1, 'a')
-
-#write tab-delimited file with extended results
-fh_out1.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params\n")
-for row in summary_list:
-    for val in row:
-        fh_out1.write("{}\t".format(val))
-    fh_out1.write("\n")
-
-#create output file 2
-out2 = "Results_Summary_Short.txt"
-fh_out2 = open(out2, 'a')
-
-#write tab-delimited file with simplified results
-fh_out2.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params\n")
-for row in simple_list:
-    for val in row:
-        fh_out2.write("{}\t".format(val))
-    fh_out2.write("\n")
-
-#close output files
-fh_out1.close()
-fh_out2.close()
-
-print "\n\nSummary files '{0}' and '{1}' have been written to {2}\n\n".format(out1, out2, file_dir)
+        simple_list.append(top_rows[0])
+
+    #sort the list containing only the top entry for each model by order of AIC
+    simple_list.sort(key=lambda x: float(x[3]))
+
+    #write tab-delimited files with extended and simplified results
+    out1 = "Results_Summary_Extended.txt"
+    write_summary(out1, summary_list)
+    out2 = "Results_Summary_Short.txt"
+    write_summary(out2, simple_list)
+
+    print "\n\nSummary files '{0}' and '{1}' have been written to {2}\n\n".format(out1, out2, file_dir)
+
+#===========================================================================
+#the pool of processes used by main starts new copies of this script on some systems (ex. Windows),
+#so the summary is only run when the script itself is run, not when it is imported
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        main(sys.argv[1], int(sys.argv[2]))
+    else:
+        main(sys.argv[1])
 
 #===========================================================================
@@ -87,8 +87,15 @@ Updated May 2018
 #**************
 snps = "/Users/dan/Dropbox/dadi_inputs/General_Script/dadi_2pops_North_South_snps.txt"
 
-#Create python dictionary from snps file
-dd = dadi.Misc.make_data_dict(snps)
+#**************
+#folder for a binary copy of the snps file, None puts it next to the snps file (as "snps.cache"),
+#give a folder you can write to if the snps file is in a read-only or shared directory
+cache_dir = None
+
+#Read the allele counts from the snps file, the first time a binary copy is saved in cache_dir,
+#which later runs load instead for as long as the snps file is unchanged; if the copy can't be
+#saved, the snps file is read through again whenever it is used
+snp_data = Optimize_Functions.Load_SNPs(snps, cache_dir=cache_dir)
 
 #**************
 #pop_ids is a list which should match the populations headers of your SNPs file columns
@@ -98,9 +105,9 @@ pop_ids=["North", "South"]
 #projection sizes, in ALLELES not individuals
 proj = [16,32]
 
-#Convert this dictionary into folded AFS object
+#Convert the allele counts into folded AFS object
 #[polarized = False] creates folded spectrum object
-fs = dadi.Spectrum.from_data_dict(dd, pop_ids=pop_ids, projections = proj, polarized = False)
+fs = Optimize_Functions.Spectrum_From_SNPs(snp_data, pop_ids=pop_ids, projections = proj, polarized = False)
 
 #print some useful information about the afs or jsfs
 print "\n\n============================================================================\nData for site frequency spectrum\n============================================================================\n"
@@ -134,6 +141,28 @@ print "Sum of SFS = ", sfs_sum, '\n', '\n'
      in_upper: a list of upper bound values
      in_lower: a list of lower bound values
      param_labels: list of labels for parameters that will be written to the output file to keep track of their order
+     workers: number of processes used to run the replicates of each round in parallel (default None runs them one at a time)
+     resume: if True, keep a checkpoint so a killed job can pick up where it stopped when run again (default False)
+     cache_size: number of model spectra kept in memory so repeated evaluations are not integrated again (default 10, 0 turns this off)
+     cache_dir: a directory where model spectra are also saved, so later runs and other scripts can reuse them (default None)
+     cache_dir_mb: size limit in megabytes for cache_dir, the least recently used spectra are removed past this (default 1000)
+     parallel_grids: if True, evaluate the model at each of the pts grid sizes at the same time in separate processes (default False)
+     seed: integer the starting parameters of every replicate are derived from, so a run can be repeated exactly (default None)
+     prune_factor: stop a replicate early once its best log-likelihood is this many times worse than the round's best so far (default None)
+     prune_after: number of model evaluations every replicate gets before it can be stopped early (default 20)
+     converge_k: if given, keep adding replicates to a round until its best converge_k log-likelihoods are within converge_tol (default None)
+     converge_tol: largest difference in log-likelihood allowed between the best converge_k replicates of a round (default 1.0)
+     max_reps: a list of integers, the largest number of replicates in each round when converge_k is used (default twice reps)
+     results_db: path to an SQLite file every replicate is also added to, see Export_Results to write it out as text (default None)
+     trace: if True, save the log-likelihood, parameters and timings of every model evaluation, one file per replicate in the folder outfile.model_name.trace (default False)
+     timings: if True, save the time spent on each step of the optimizations, per round and in total, to outfile.model_name.timings.json (default False)
+     round_pts: a list with the grid sizes to use in each round, ex. [[20,30,40],[40,50,60],None], None uses pts (default None uses pts in every round)
+     round_projections: a list with the sample sizes to project fs down to in each round, ex. [[8,16],[12,24],None], None uses fs (default None uses fs in every round)
+     start_design: "lhs" or "halton" to spread the first round's starting parameters evenly between the bounds, instead of perturbing in_params (default None)
+     prescreen: number of candidate starting parameters to evaluate the model at once each, so the first round starts from the best of them (default None)
+     prescreen_keep: number of the best scoring candidates the first round starts from (default None keeps one for every replicate of the first round)
+     top_k: if given, the replicates of each later round take turns perturbing the best top_k distinct replicates so far, rather than the single best (default None)
+     top_k_distance: smallest root mean square difference between the log parameters of two replicates for both to be used with top_k (default 0.1)
 '''
 
 
@@ -0,0 +1,99 @@
+import os
+import sys
+import numpy
+import dadi
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Optimize_Functions
+'''
+usage: python -m pytest tests
+
+Checks that Optimize_Routine writes the same replicates when it is run again
+with the same seed, whether the replicates are run one at a time or on
+worker processes, and when a run stopped part way through is resumed, and
+that with converge_k every round runs at least its reps replicates.
+
+-------------------------
+Written for Python 2.7
+Python modules required:
+-Numpy
+-dadi
+-pytest
+-------------------------
+'''
+
+PTS = [20, 30, 40]
+
+def two_epoch(params, ns, pts):
+    return dadi.Demographics1D.two_epoch(params, ns, pts)
+
+class Interrupted(Exception):
+    pass
+
+#number of model evaluations interrupted_two_epoch allows before it stops the run, as if the job was killed
+evaluations_left = [0]
+
+def interrupted_two_epoch(params, ns, pts):
+    evaluations_left[0] -= 1
+    if evaluations_left[0] < 0:
+        raise Interrupted()
+    return two_epoch(params, ns, pts)
+
+def make_fs():
+    #a spectrum sampled from the model itself, so the optimizations are quick
+    func_ex = dadi.Numerics.make_extrap_log_func(two_epoch)
+    numpy.random.seed(12345)
+    return (func_ex([2.0, 0.1], [10], PTS) * 1000).sample()
+
+def run(tmpdir, prefix, func, **kwargs):
+    #optimize for two short rounds and return the text of the optimized.txt file
+    outfile = str(tmpdir.join(prefix))
+    Optimize_Functions.Optimize_Routine(make_fs(), PTS, outfile, "two_epoch", func, 2, 2, reps=[3, 3], maxiters=[3, 3], **kwargs)
+    fh_in = open("{}.two_epoch.optimized.txt".format(outfile), 'r')
+    text = fh_in.read()
+    fh_in.close()
+    return text
+
+def test_same_seed_same_replicates(tmpdir):
+    first = run(tmpdir, "first", two_epoch, seed=7)
+    assert first == run(tmpdir, "second", two_epoch, seed=7)
+    assert first != run(tmpdir, "other", two_epoch, seed=8)
+
+def test_workers_match_serial(tmpdir):
+    assert run(tmpdir, "serial", two_epoch, seed=7) == run(tmpdir, "workers", two_epoch, seed=7, workers=2)
+
+def test_resume_matches_uninterrupted(tmpdir):
+    #count the evaluations of a whole run, then stop a second run half way through and resume it
+    #(without the spectrum cache, so both runs evaluate the model the same number of times)
+    evaluations_left[0] = 10**9
+    expected = run(tmpdir, "whole", interrupted_two_epoch, seed=7, resume=True, cache_size=0)
+    evaluations = 10**9 - evaluations_left[0]
+    evaluations_left[0] = evaluations // 2
+    try:
+        run(tmpdir, "resumed", interrupted_two_epoch, seed=7, resume=True, cache_size=0)
+    except Interrupted:
+        pass
+    else:
+        assert False, "the run was not interrupted"
+    checkpoint_name = str(tmpdir.join("resumed.two_epoch.checkpoint.pkl"))
+    assert os.path.exists(checkpoint_name)
+    #the seed is read back from the checkpoint
+    assert run(tmpdir, "resumed", two_epoch, resume=True) == expected
+    assert not os.path.exists(checkpoint_name)
+
+def test_finished_run_is_not_resumed(tmpdir):
+    #rows of a run that finished are not taken as done by a later run with the same prefix
+    first = run(tmpdir, "again", two_epoch, seed=7, resume=True)
+    both = run(tmpdir, "again", two_epoch, seed=8, resume=True)
+    assert both.startswith(first)
+    assert both[len(first):] == run(tmpdir, "other", two_epoch, seed=8)
+
+def round_replicates(text, round_number):
+    return sum(1 for line in text.splitlines() if "\tRound_{}_Replicate_".format(round_number) in line)
+
+def test_converge_k_runs_at_least_reps(tmpdir):
+    #with a tolerance every round meets at once, each round still runs its 3 replicates
+    converged = run(tmpdir, "converged", two_epoch, seed=7, converge_k=2, converge_tol=1e9)
+    assert [round_replicates(converged, x) for x in [1, 2]] == [3, 3]
+    #and with one no round can meet, each round runs up to max_reps
+    unconverged = run(tmpdir, "unconverged", two_epoch, seed=7, converge_k=2, converge_tol=-1, max_reps=[4, 5])
+    assert [round_replicates(unconverged, x) for x in [1, 2]] == [4, 5]
@@ -0,0 +1,93 @@
+import os
+import sys
+import multiprocessing
+import numpy
+import dadi
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Optimize_Functions
+'''
+usage: python -m pytest tests
+
+Checks that Load_SNPs and Spectrum_From_SNPs give the same spectrum as
+dadi.Misc.make_data_dict and dadi.Spectrum.from_data_dict, for a SNPs file
+where some lines share a Gene and Position (make_data_dict keeps the last),
+that Spectrum_From_SNPs gives the same spectrum whatever the chunk size,
+and that several jobs building the binary copy of the same file at once
+all end up with the same allele counts.
+
+-------------------------
+Written for Python 2.7
+Python modules required:
+-Numpy
+-dadi
+-pytest
+-------------------------
+'''
+
+#the third and last lines repeat the names of earlier lines with other counts, and one SNP can't be polarized
+SNPS = """Ingroup	Outgroup	Allele1	North	South	Allele2	North	South	Gene	Position
+-A-	-A-	A	6	3	G	2	5	1	15
+-G-	-A-	G	7	8	A	1	0	2	15
+-A-	-G-	A	4	6	G	4	2	1	15
+-C-	---	C	8	4	T	0	4	3	20
+-T-	-T-	T	5	7	C	3	1	4	20
+-G-	-G-	G	3	2	A	5	6	2	15
+"""
+
+def write_snps(tmpdir):
+    snps = str(tmpdir.join("dup_snps.txt"))
+    fh_snps = open(snps, 'w')
+    fh_snps.write(SNPS)
+    fh_snps.close()
+    return snps
+
+def test_duplicate_names_match_make_data_dict(tmpdir):
+    snps = write_snps(tmpdir)
+    pop_ids = ["North", "South"]
+    proj = [6, 6]
+    dd = dadi.Misc.make_data_dict(snps)
+    snp_data = Optimize_Functions.Load_SNPs(snps, cache_dir=str(tmpdir.join("cache")))
+    for polarized in [True, False]:
+        expected = dadi.Spectrum.from_data_dict(dd, pop_ids, proj, polarized=polarized)
+        #both from the binary copy and from streaming the file
+        for source in [snp_data, snps]:
+            fs = Optimize_Functions.Spectrum_From_SNPs(source, pop_ids=pop_ids, projections=proj, polarized=polarized)
+            assert numpy.allclose(fs.data, expected.data)
+            assert numpy.array_equal(fs.mask, expected.mask)
+
+def test_chunk_size_does_not_change_spectrum(tmpdir):
+    snps = write_snps(tmpdir)
+    pop_ids = ["North", "South"]
+    proj = [6, 6]
+    snp_data = Optimize_Functions.Load_SNPs(snps, cache_dir=str(tmpdir.join("cache")))
+    for source in [snp_data, snps]:
+        expected = Optimize_Functions.Spectrum_From_SNPs(source, pop_ids=pop_ids, projections=proj, polarized=False)
+        for chunk_size in [1, 2, 4]:
+            fs = Optimize_Functions.Spectrum_From_SNPs(source, pop_ids=pop_ids, projections=proj, polarized=False, chunk_size=chunk_size)
+            assert numpy.allclose(fs.data, expected.data)
+            assert numpy.array_equal(fs.mask, expected.mask)
+
+def test_unwritable_cache_falls_back_to_file(tmpdir):
+    snps = write_snps(tmpdir)
+    #a file where the cache folder should be, so it can't be created
+    blocked = str(tmpdir.join("blocked"))
+    open(blocked, 'w').close()
+    snp_data = Optimize_Functions.Load_SNPs(snps, cache_dir=os.path.join(blocked, "cache"))
+    assert snp_data == snps
+
+def load_counts(args):
+    snps, cache_dir = args
+    snp_data = Optimize_Functions.Load_SNPs(snps, cache_dir=cache_dir, chunk_size=2)
+    return [numpy.array(snp_data[name]).tolist() for name in ['calls1', 'calls2', 'polarity']]
+
+def test_concurrent_loads_share_one_copy(tmpdir):
+    snps = write_snps(tmpdir)
+    cache_dir = str(tmpdir.join("cache"))
+    pool = multiprocessing.Pool(4)
+    loaded = pool.map(load_counts, [(snps, cache_dir)] * 8)
+    pool.close()
+    pool.join()
+    expected = load_counts((snps, str(tmpdir.join("cache_alone"))))
+    assert all(counts == expected for counts in loaded)
+    #only the finished copy is left, no temporary files
+    assert sorted(os.listdir(cache_dir)) == ['calls1.bin', 'calls2.bin', 'index.pkl', 'polarity.bin']